@@ -0,0 +1,191 @@
+"""
+Benchmark every stage of the pipeline on simulated data, at increasing scales.
+
+For each number of sessions, this simulates a bigquery export from a known click model
+(see simulate.py), and then times each stage:
+
+- clean: clean_data_from_bigquery.clean
+- summarise: load_sessions.summarise_sessions
+- load: SessionLoader, into a temporary SQLite database unless --database-url is set
+- read: get_searches
+- split: training_and_test, and encoding the training set
+- train_sdbn, train_dbn: training each click model
+- evaluate: building a relevance index and running ModelTester on the test set
+
+It records the peak memory allocated during each stage (with tracemalloc, which makes
+python-heavy stages slower, so turn it off with --no-trace-memory for timings only),
+and the process's maximum resident set size so far.
+
+Finally it checks how well each model recovered the true parameters, as the correlation
+between the true and estimated attractiveness and satisfaction of every (query, document)
+that was examined at least MIN_EXAMINATIONS times. It also checks that CounterfactualTester
+prefers an oracle ranking (by the true attractiveness x satisfaction) to the original one.
+
+Usage: python benchmark.py --scales 10000 100000 --output benchmark.csv
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from simulate import simulate_searches, to_bigquery_export
+from clean_data_from_bigquery import clean
+from load_sessions import summarise_sessions
+from database import metadata, SessionLoader, record_dataset, get_searches
+from split_data import training_and_test
+from session_store import SessionStore
+from estimate_relevance import SimplifiedDBNModel, DynamicBayesianNetworkModel, ClickModel
+from relevance_index import RelevanceIndex
+from evaluate_model import ModelTester, QueryDocumentRanker, CounterfactualTester
+
+
+class Benchmark:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = []
+
+    @contextmanager
+    def stage(self, name, scale):
+        if self.trace_memory:
+            tracemalloc.start()
+
+        start = time.time()
+        yield
+        seconds = time.time() - start
+
+        peak_mb = np.nan
+        if self.trace_memory:
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+        # ru_maxrss is in kilobytes on linux
+        max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+        self.results.append({
+            'sessions': scale,
+            'stage': name,
+            'seconds': seconds,
+            'peak_mb': peak_mb,
+            'max_rss_mb': max_rss_mb,
+        })
+        print(f'\t{name}: {seconds:.2f}s, peak {peak_mb:.0f}MB, max RSS {max_rss_mb:.0f}MB')
+
+
+def parameter_recovery(model, parameters):
+    """
+    Compare a trained model to the parameters the sessions were simulated from
+    """
+    params = model.document_params
+    estimates = pd.DataFrame({
+        'attractiveness_estimate': params.attr_numerator / params.attr_denominator,
+        'satisfaction_estimate': params.sat_numerator / params.sat_denominator,
+        'examinations': params.attr_denominator - ClickModel.PRIOR_DENOMINATOR,
+    })
+    joined = parameters.join(estimates, how='inner')
+    joined = joined[joined.examinations >= ClickModel.MIN_EXAMINATIONS]
+
+    return {
+        'pairs': len(joined),
+        'attractiveness_correlation': np.corrcoef(joined.attractiveness, joined.attractiveness_estimate)[0, 1],
+        'satisfaction_correlation': np.corrcoef(joined.satisfaction, joined.satisfaction_estimate)[0, 1],
+        'attractiveness_error': (joined.attractiveness - joined.attractiveness_estimate).abs().mean(),
+    }
+
+
+def oracle_preference(click_model, parameters, test, seed=None):
+    """
+    Run CounterfactualTester on a ranking by the true relevance of every document.
+    This should always beat the original ranking, which is random.
+    """
+    oracle = RelevanceIndex.from_table(pd.DataFrame({
+        'relevance': parameters.attractiveness * parameters.satisfaction,
+        'examinations': ClickModel.MIN_EXAMINATIONS,
+    }, index=parameters.index))
+    evaluation = CounterfactualTester(QueryDocumentRanker(oracle), click_model, seed=seed).evaluate(test.copy())
+    return CounterfactualTester.summarise(evaluation)['interleaving_preference']
+
+
+def run(benchmark, scale, engine, args):
+    print(f'{scale} sessions')
+    searches, parameters = simulate_searches(scale, n_queries=args.queries, gamma=args.gamma, seed=args.seed)
+    export = to_bigquery_export(searches)
+
+    with benchmark.stage('clean', scale):
+        cleaned = clean(export)
+
+    with benchmark.stage('summarise', scale):
+        invalid_counter = Counter()
+        sessions = summarise_sessions(cleaned, invalid_counter=invalid_counter)
+
+    conn = engine.connect()
+    with benchmark.stage('load', scale):
+        dataset_id = record_dataset(conn, f'benchmark-{scale}-{time.time()}')
+        loader = SessionLoader(conn, dataset_id=dataset_id, high_volume_threshold=0)
+        loader.load(sessions, invalid_counter=invalid_counter)
+        loader.finish()
+
+    with benchmark.stage('read', scale):
+        searches = get_searches(conn, dataset_ids=[dataset_id])
+
+    with benchmark.stage('split', scale):
+        training, test = training_and_test(searches, seed=args.seed)
+        training_sessions = SessionStore.from_frame(training).encoded()
+
+    with benchmark.stage('train_sdbn', scale):
+        sdbn = SimplifiedDBNModel().train(training_sessions)
+
+    with benchmark.stage('train_dbn', scale):
+        dbn = DynamicBayesianNetworkModel(max_iterations=args.dbn_iterations, processes=args.processes).train(training_sessions)
+
+    with benchmark.stage('evaluate', scale):
+        index = RelevanceIndex.build(sdbn)
+        ModelTester(QueryDocumentRanker(index)).evaluate(test.copy())
+
+    recovery = []
+    for name, model in [('sdbn', sdbn), ('dbn', dbn)]:
+        recovery.append(dict(parameter_recovery(model, parameters), sessions=scale, model=name))
+        print(f'\t{name} parameter recovery: {recovery[-1]}')
+
+    preference = oracle_preference(sdbn, parameters, test, seed=args.seed)
+    print(f'\toracle interleaving preference: {preference:.3f}')
+    if preference <= 0:
+        print('\tWARNING: the counterfactual evaluation prefers the original ranking to the oracle')
+
+    return recovery
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on simulated sessions')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000], help='Numbers of sessions to simulate')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--gamma', type=float, default=1.0, help='Simulate from a DBN with this continuation probability')
+    parser.add_argument('--dbn-iterations', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url', help='Database to load into (by default, a temporary SQLite database)')
+    parser.add_argument('--no-trace-memory', action='store_true', help="Don't measure memory for each stage, which makes the timings more accurate")
+    parser.add_argument('--output', help='Save the timings to a CSV file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sqlalchemy.create_engine(args.database_url or f'sqlite:///{os.path.join(tmp, "benchmark.db")}')
+        metadata.create_all(engine)
+
+        benchmark = Benchmark(trace_memory=not args.no_trace_memory)
+        recovery = []
+        for scale in args.scales:
+            recovery.extend(run(benchmark, scale, engine, args))
+
+    timings = pd.DataFrame(benchmark.results)
+    print(timings.pivot(index='stage', columns='sessions', values='seconds').reindex(timings.stage.unique()))
+    print(pd.DataFrame(recovery).set_index(['sessions', 'model']))
+
+    if args.output:
+        timings.to_csv(args.output, index=False)
@@ -1,14 +1,13 @@
-from google.cloud import bigquery
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
-from google.oauth2 import service_account
-from os import environ
-import pandas_gbq
+from datetime import date
+from extract_cache import ExtractCache, CACHE_DIR
+
+PROJECT_ID = 'govuk-bigquery-analytics'
+PRIVATE_KEY = 'govuk_bigquery.json'
 
 # There are ~100,000 sessions involving search per day
 # and the estimated results size is around 1GB per week of data
 # TODO: measure the actual size
-query = '''
+QUERY_TEMPLATE = '''
 SELECT
 CONCAT(fullVisitorId,'|',CAST(visitId as STRING)) AS sessionId,
 customDimensions.value as searchTerm,
@@ -27,10 +26,53 @@ CROSS JOIN UNNEST(hits.product) as product
 CROSS JOIN UNNEST(product.customDimensions) as customDimensions
 
 WHERE product.productListName = 'Site search results'
-AND _TABLE_SUFFIX BETWEEN '20180422' AND '20180425'
+AND _TABLE_SUFFIX BETWEEN '{start_date:%Y%m%d}' AND '{end_date:%Y%m%d}'
 AND product.productListPosition <= 20
 AND customDimensions.index = 71
+
+-- Keep all rows for a session together, so the output can be processed in chunks
+ORDER BY sessionId
 '''
 
-results = pandas_gbq.read_gbq(query, project_id='govuk-bigquery-analytics', private_key='govuk_bigquery.json', dialect='standard')
-results.to_csv('data/bigquery_results_20180422_20180425.csv', index=False)
\ No newline at end of file
+
+def search_sessions_query(start_date, end_date):
+    """
+    Get the query for search sessions between two dates (inclusive)
+    """
+    return QUERY_TEMPLATE.format(start_date=start_date, end_date=end_date)
+
+
+class BigQuerySource:
+    """
+    Runs queries against the real google analytics data.
+
+    The google libraries are only imported when a query is run, so the rest of the
+    pipeline can run offline (with --fixtures) without them installed.
+    """
+    name = 'bigquery'
+    query_template = QUERY_TEMPLATE
+
+    def read(self, query):
+        import pandas_gbq
+        return pandas_gbq.read_gbq(query, project_id=PROJECT_ID, private_key=PRIVATE_KEY, dialect='standard')
+
+
+def export_search_sessions(start_date, end_date, output_filename, source=None, cache_dir=CACHE_DIR):
+    """
+    Export search sessions between two dates (inclusive) to a CSV file.
+
+    Each day's results are cached, so only days that haven't been exported before
+    are fetched from the source (bigquery, unless another source is given).
+    """
+    cache = ExtractCache(source or BigQuerySource(), directory=cache_dir)
+    results = cache.fetch_range(start_date, end_date)
+
+    # Each day is sorted separately, but sessions can continue past midnight
+    results = results.sort_values('sessionId', kind='mergesort')
+
+    results.to_csv(output_filename, index=False)
+    return len(results)
+
+
+if __name__ == '__main__':
+    export_search_sessions(date(2018, 4, 22), date(2018, 4, 25), 'data/bigquery_results_20180422_20180425.csv')
@@ -0,0 +1,166 @@
+"""
+Bootstrap confidence intervals for the relevance estimates, and the evaluation
+metrics based on them.
+
+This resamples the training sessions for each query (with replacement), retrains the
+Simplified DBN model, and re-runs the ModelTester metrics on a resample of the test set,
+many times over. Because the SDBN model is just ratios of counts, each replicate only
+needs a weighted count of the encoded sessions, so 1000 replicates is practical.
+
+Replicates run in a pool of worker processes, and replicate i always uses seed + i,
+so the results don't depend on the number of processes.
+
+Usage: python bootstrap.py --replicates 1000 --output data/relevance_intervals.csv
+"""
+import argparse
+import time
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import pandas as pd
+from estimate_relevance import SimplifiedDBNModel
+from relevance_index import RelevanceIndex
+from evaluate_model import ModelTester, QueryDocumentRanker
+from split_data import load_stores
+from uncertainty import relevance_errors
+
+
+def resample_within_queries(query_ids, random_state):
+    """
+    Resample sessions with replacement, separately for each query, so every query
+    keeps the same number of sessions.
+
+    Returns the number of times each session was drawn.
+    """
+    order = np.argsort(query_ids, kind='mergesort')
+    sorted_query_ids = query_ids[order]
+    query_sizes = np.bincount(query_ids)
+    query_starts = np.r_[0, np.cumsum(query_sizes)[:-1]]
+
+    draws = query_starts[sorted_query_ids] + (random_state.random_sample(len(order)) * query_sizes[sorted_query_ids]).astype(np.int64)
+    return np.bincount(order[draws], minlength=len(query_ids))
+
+
+# Everything each pool worker needs to run a replicate
+_worker_state = None
+
+
+def _init_bootstrap_worker(training, test, test_query_ids, selected):
+    global _worker_state
+    _worker_state = (training, test, test_query_ids, selected)
+
+
+def bootstrap_replicate(training, test, test_query_ids, selected, random_state):
+    """
+    Retrain the SDBN model on a resample of the training sessions, and evaluate it on
+    a resample of the test set.
+
+    Returns the relevance of the selected (query, document) pairs, and the mean
+    change in rank and saved clicks.
+    """
+    weights = resample_within_queries(training.query_ids, random_state)
+    model = SimplifiedDBNModel.from_counts(SimplifiedDBNModel.count(training, weights=weights))
+    relevance = (model.attractiveness * model.satisfaction).values[selected].astype(np.float32)
+
+    # Run the test set once, and then weight each session by how often it was drawn
+    test_weights = resample_within_queries(test_query_ids, random_state)
+    evaluation = ModelTester(QueryDocumentRanker(RelevanceIndex.build(model))).evaluate(test.copy())
+
+    return relevance, {
+        'change_in_rank': np.average(evaluation.change_in_rank, weights=test_weights),
+        'saved_clicks': np.average(evaluation.saved_clicks, weights=test_weights),
+    }
+
+
+def _run_bootstrap_replicate(seed):
+    return bootstrap_replicate(*_worker_state, np.random.RandomState(seed))
+
+
+def bootstrap(training, test, n_replicates=1000, seed=0, processes=None):
+    """
+    Bootstrap the relevance of every document that has been examined enough times,
+    and the ModelTester metrics.
+
+    training is a set of EncodedSessions, and test is a dataframe of searches.
+
+    Returns (model, relevance, metrics), where model is trained on all of the training
+    sessions, relevance is a (replicates x documents) array for the rows of
+    model.relevance_table(), and metrics has a row for each replicate.
+    """
+    model = SimplifiedDBNModel().train(training)
+    selected = (model.document_params.attr_denominator >= model.MIN_EXAMINATIONS).values
+    test_query_ids = pd.factorize(test.search_term_lowercase)[0]
+
+    seeds = [seed + i for i in range(n_replicates)]
+    state = (training, test, test_query_ids, selected)
+
+    if processes:
+        with Pool(processes, initializer=_init_bootstrap_worker, initargs=state) as pool:
+            results = pool.map(_run_bootstrap_replicate, seeds)
+    else:
+        results = [bootstrap_replicate(*state, np.random.RandomState(replicate_seed)) for replicate_seed in seeds]
+
+    relevance = np.array([result[0] for result in results], dtype=np.float32).reshape(n_replicates, selected.sum())
+    metrics = pd.DataFrame([result[1] for result in results], columns=['change_in_rank', 'saved_clicks'])
+    return model, relevance, metrics
+
+
+def confidence_intervals(estimates, replicates, confidence=0.95):
+    """
+    Percentile confidence intervals for each column of a (replicates x estimates) array
+    """
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.percentile(replicates, [tail, 100 - tail], axis=0)
+    return pd.DataFrame(
+        {
+            'estimate': estimates,
+            'lower': lower,
+            'upper': upper,
+            'standard_error': replicates.std(axis=0, ddof=1),
+        },
+        columns=['estimate', 'lower', 'upper', 'standard_error']
+    )
+
+
+def relevance_intervals(model, relevance, confidence=0.95):
+    """
+    Confidence intervals for the relevance of every document, indexed by (query, document)
+    """
+    table = model.relevance_table()
+    intervals = confidence_intervals(table.relevance.values, relevance, confidence)
+    intervals.index = table.index
+    intervals['propagated_error'] = relevance_errors(model).reindex(table.index).values
+    intervals['examinations'] = table.examinations.values
+    return intervals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bootstrap confidence intervals for relevance and the evaluation metrics')
+    parser.add_argument('--replicates', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=cpu_count())
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--output', help='Save the relevance intervals to a CSV file')
+    args = parser.parse_args()
+
+    training_store, test_store = load_stores()
+    training = training_store.encoded()
+    test = test_store.to_frame()
+
+    start = time.time()
+    model, relevance, metrics = bootstrap(training, test, n_replicates=args.replicates, seed=args.seed, processes=args.processes)
+    print(f'Ran {args.replicates} replicates in {time.time() - start:.0f}s')
+
+    evaluation = ModelTester(QueryDocumentRanker(RelevanceIndex.build(model))).evaluate(test.copy())
+    metric_intervals = confidence_intervals(
+        [evaluation.change_in_rank.mean(), evaluation.saved_clicks.mean()],
+        metrics.values,
+        args.confidence
+    )
+    metric_intervals.index = metrics.columns
+    print(metric_intervals)
+
+    intervals = relevance_intervals(model, relevance, args.confidence)
+    print(f'Median width of relevance intervals: {(intervals.upper - intervals.lower).median()}')
+
+    if args.output:
+        intervals.to_csv(args.output)
@@ -4,13 +4,43 @@ from nltk.tokenize import wordpunct_tokenize
 from nltk.stem.porter import PorterStemmer
 import sys
 import os
+import argparse
+from functools import lru_cache
+from multiprocessing import Pool
 
 porter_stemmer = PorterStemmer()
 
+# There are very few distinct tokens compared to the number of rows,
+# so stemming each one once saves most of the work
+STEM_CACHE_SIZE = 100000
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(token):
+    return porter_stemmer.stem(token)
+
 
 def normalise_search_terms(terms):
     tokens = wordpunct_tokenize(terms)
-    return ' '.join([porter_stemmer.stem(token) for token in tokens])
+    return ' '.join([stem(token) for token in tokens])
+
+
+def normalise_column(search_terms, pool=None):
+    """
+    Normalise a series of search terms.
+
+    Each distinct search term is only normalised once, and the result is then
+    mapped back onto every row. If a multiprocessing pool is given, the distinct terms
+    are split between the worker processes.
+    """
+    unique_terms = search_terms.unique()
+
+    if pool is None:
+        normalised = [normalise_search_terms(terms) for terms in unique_terms]
+    else:
+        normalised = pool.map(normalise_search_terms, unique_terms, chunksize=1000)
+
+    return search_terms.map(dict(zip(unique_terms, normalised)))
 
 
 def filter_out_queries_with_not_enough_sessions(df):
@@ -33,16 +63,11 @@ def filter_out_queries_with_not_enough_sessions(df):
     return df[df.searchTerm.isin(enough_sessions.index)]
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('Usage: python clean_data_from_bigquery.py [input_filename] [output_filename]')
-        sys.exit(1)
-
-    # There are a handful of searches for literally "null"
-    # Don't try and interpret that
-    df = pd.read_csv(sys.argv[1], na_filter=False)
-
-    print('Renaming columns')
+def clean(df, pool=None):
+    """
+    Rename the columns from the bigquery export and add normalised search terms.
+    Each row is cleaned independently, so this can be applied to one chunk at a time.
+    """
     df = df.rename(
         {
             'ga:productSku': 'contentIdOrPath',
@@ -52,9 +77,42 @@ if __name__ == '__main__':
         }, axis='columns'
     )
 
-    df['searchTerm'] = df.originalSearchTerm.apply(normalise_search_terms)
-    #df = filter_out_queries_with_not_enough_sessions(df)
+    df['searchTerm'] = normalise_column(df.originalSearchTerm, pool=pool)
+    return df
 
-    print(f'There are {df.searchSessionId.nunique()} unique sessions in the dataset')
 
-    df.to_csv(sys.argv[2], index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean up the output of bigquery.py')
+    parser.add_argument('input_filename')
+    parser.add_argument('output_filename')
+    parser.add_argument('--chunksize', type=int, help='Stream the input this many rows at a time instead of loading it all into memory')
+    parser.add_argument('--processes', type=int, help='Normalise search terms using this many worker processes')
+    args = parser.parse_args()
+
+    pool = Pool(args.processes) if args.processes else None
+
+    # There are a handful of searches for literally "null"
+    # Don't try and interpret that
+    if args.chunksize:
+        chunks = pd.read_csv(args.input_filename, na_filter=False, chunksize=args.chunksize)
+    else:
+        chunks = [pd.read_csv(args.input_filename, na_filter=False)]
+
+    rows = 0
+    sessions = 0
+    last_session_id = None
+    for i, df in enumerate(chunks):
+        print(f'Cleaning rows {rows} to {rows + len(df)}')
+        df = clean(df, pool=pool)
+        #df = filter_out_queries_with_not_enough_sessions(df)
+
+        df.to_csv(args.output_filename, index=False, mode='w' if i == 0 else 'a', header=(i == 0))
+        rows += len(df)
+
+        # The export is sorted by session, so only the first session in a chunk
+        # can have been counted already
+        if len(df):
+            sessions += df.searchSessionId.nunique() - int(df.searchSessionId.iloc[0] == last_session_id)
+            last_session_id = df.searchSessionId.iloc[-1]
+
+    print(f'There are {sessions} unique sessions in the dataset')
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""
+Convert a PyClick SDBN model saved as JSON into the binary model format,
+which loads much faster.
+"""
+import sys
+from evaluate_model import PyClickModelAdapter
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python convert_model.py [input json] [output directory]')
+        sys.exit(1)
+
+    model = PyClickModelAdapter.from_json(sys.argv[1]).to_click_model()
+    model.save(sys.argv[2])
+    print(f'Converted {len(model.document_params)} (query, document) pairs')
@@ -1,44 +1,134 @@
 """
 A database for storing session summaries.
+
+This is normally Postgres, but DATABASE_URL can also point to a SQLite file
+(e.g. sqlite:///data/accelerator.db), which is handy for laptops and CI.
+SQLite doesn't have arrays, so these are stored as JSON instead.
 """
 import os
+import json
 import logging
+from collections import ChainMap, Counter
 import sqlalchemy
-from sqlalchemy import Table, Column, BigInteger, Integer, Boolean, String, Date, MetaData, ForeignKey, ARRAY
-from sqlalchemy.sql import func, select, insert, except_
+from sqlalchemy import Table, Column, BigInteger, Integer, Boolean, String, Text, Date, MetaData, ForeignKey, ARRAY, PrimaryKeyConstraint
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.sql import func, select, insert, except_, bindparam, text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as upsert
+import numpy as np
 import pandas as pd
 
 DATABASE_URL = os.environ.get('DATABASE_URL', 'postgres://localhost/accelerator')
 engine = sqlalchemy.create_engine(DATABASE_URL)
 metadata = MetaData()
 
+# Number of sessions to write per transaction when bulk loading
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 10000))
+
+# Number of searches to read from the database at a time when streaming
+READ_CHUNKSIZE = int(os.environ.get('READ_CHUNKSIZE', 50000))
+
+# Queries with more sessions than this are high volume
+HIGH_VOLUME_THRESHOLD = int(os.environ.get('HIGH_VOLUME_THRESHOLD', 1000))
+
+# SQLite limits the number of parameters in a single statement
+SQLITE_MAX_PARAMETERS = 900
+
+# SQLite only autoincrements INTEGER PRIMARY KEY columns
+ID = BigInteger().with_variant(Integer, 'sqlite')
+
+
+class IntegerArray(TypeDecorator):
+    """
+    An array of integers, which is stored as JSON in databases that don't support arrays
+    """
+    impl = Text
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(ARRAY(Integer))
+        return dialect.type_descriptor(Text())
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name == 'postgresql' or value is None:
+            return value
+        return json.dumps([int(item) for item in value])
+
+    def process_result_value(self, value, dialect):
+        if dialect.name == 'postgresql' or value is None:
+            return value
+        return json.loads(value)
+
+
+# URLs are stored as IDs from the results table (see migrate_database.py).
+# This table may be partitioned by dataset_id, in which case the primary key is (id, dataset_id).
 search_table = Table('searches', metadata,
-    Column('id', BigInteger, primary_key=True),
-    Column('query_id', None, ForeignKey('queries.query_id', ondelete='CASCADE')),
-    Column('dataset_id', None, ForeignKey('datasets.dataset_id', ondelete='CASCADE')),
-    Column('clicked_urls', ARRAY(String), nullable=False),
-    Column('all_urls', ARRAY(String), nullable=False),
-    Column('final_click_url', String, nullable=False),
+    Column('id', ID, primary_key=True),
+    Column('query_id', None, ForeignKey('queries.query_id', ondelete='CASCADE'), index=True),
+    Column('dataset_id', None, ForeignKey('datasets.dataset_id', ondelete='CASCADE'), index=True),
+    Column('clicked_result_ids', IntegerArray, nullable=False),
+    Column('all_result_ids', IntegerArray, nullable=False),
+    Column('final_click_result_id', None, ForeignKey('results.result_id'), nullable=False),
     Column('final_click_rank', Integer, nullable=False)
 )
 
+# Every URL that has appeared in the search results
+result_table = Table('results', metadata,
+    Column('result_id', Integer, primary_key=True),
+    Column('url', String, unique=True, nullable=False),
+)
+
 query_table = Table('queries', metadata,
-    Column('query_id', BigInteger, primary_key=True),
+    Column('query_id', ID, primary_key=True),
     Column('search_term_lowercase', String, unique=True, nullable=False),
     Column('normalised_search_term', String, unique=False, nullable=False),
-    Column('high_volume', Boolean, default=False)
+    Column('high_volume', Boolean, default=False),
+
+    # Number of searches for this query, kept up to date when sessions are loaded
+    Column('session_count', BigInteger, nullable=False, server_default='0'),
 )
 
 dataset_table = Table('datasets', metadata,
-    Column('dataset_id', BigInteger, primary_key=True),
+    Column('dataset_id', ID, primary_key=True),
     Column('filename', String, nullable=False, unique=True),
     Column('date_loaded', Date, server_default=func.now()),
 )
 
+# How far we got loading each dataset. Every batch of sessions updates this in the
+# same transaction as the searches, so an interrupted load can be resumed after the
+# last session that was committed. Sessions are loaded in order of (session ID, search term).
+checkpoint_table = Table('load_checkpoints', metadata,
+    Column('dataset_id', None, ForeignKey('datasets.dataset_id', ondelete='CASCADE'), primary_key=True),
+    Column('last_session_id', String, nullable=True),
+    Column('last_search_term', String, nullable=True),
+    Column('sessions_loaded', BigInteger, nullable=False, server_default='0'),
+    Column('complete', Boolean, nullable=False, server_default=sqlalchemy.false()),
+)
+
+# Sessions that couldn't be inserted, so resuming the load can retry them
+failed_session_table = Table('failed_sessions', metadata,
+    Column('dataset_id', None, ForeignKey('datasets.dataset_id', ondelete='CASCADE'), nullable=False),
+    Column('search_session_id', String, nullable=False),
+    Column('search_term', String, nullable=False),
+    PrimaryKeyConstraint('dataset_id', 'search_session_id', 'search_term'),
+)
+
+# Click model sufficient statistics for each dataset, so the model
+# can be updated without reprocessing all the sessions
+sdbn_count_table = Table('sdbn_counts', metadata,
+    Column('dataset_id', None, ForeignKey('datasets.dataset_id', ondelete='CASCADE'), nullable=False),
+    Column('query_id', None, ForeignKey('queries.query_id', ondelete='CASCADE'), nullable=False),
+    Column('result_id', None, ForeignKey('results.result_id'), nullable=False),
+    Column('attr_numerator', Integer, nullable=False),
+    Column('attr_denominator', Integer, nullable=False),
+    Column('sat_numerator', Integer, nullable=False),
+    Column('sat_denominator', Integer, nullable=False),
+    PrimaryKeyConstraint('dataset_id', 'query_id', 'result_id'),
+)
+
 # Import this from the data warehouse
 content_item_table = Table('content_items', metadata,
-    Column('id', BigInteger, primary_key=True),
+    Column('id', ID, primary_key=True),
     Column('content_id', String, nullable=False),
     Column('base_path', String, nullable=False),
     Column('title', String, nullable=True),
@@ -57,106 +147,702 @@ def record_dataset(conn, input_filename):
     Create a record of the dataset we loaded from.
     Returns the ID of the inserted row.
     """
-    stmt = dataset_table.insert().values(filename=input_filename)
-    result = conn.execute(stmt)
-    return result.inserted_primary_key[0]
+    with conn.begin():
+        stmt = dataset_table.insert().values(filename=input_filename)
+        result = conn.execute(stmt)
+        dataset_id = result.inserted_primary_key[0]
+
+        conn.execute(checkpoint_table.insert().values(dataset_id=dataset_id))
+
+        if is_partitioned(conn, search_table):
+            create_search_partition(conn, dataset_id)
+
+    return dataset_id
+
+
+def get_checkpoint(conn, input_filename):
+    """
+    Find out how much of a file has been loaded already.
+
+    Returns (dataset_id, resume_after, complete), where resume_after is the
+    (session ID, search term) of the last session committed, or None if nothing
+    has been committed yet. Returns None if the file hasn't been loaded at all.
+    """
+    stmt = select(
+        [
+            dataset_table.c.dataset_id,
+            checkpoint_table.c.last_session_id,
+            checkpoint_table.c.last_search_term,
+            checkpoint_table.c.complete,
+        ]
+    ).select_from(
+        dataset_table.outerjoin(checkpoint_table)
+    ).where(dataset_table.c.filename == input_filename)
+
+    row = conn.execute(stmt).fetchone()
+    if row is None:
+        return None
+
+    dataset_id, last_session_id, last_search_term, complete = row
+
+    # Datasets loaded before checkpoints were added don't have one
+    if complete is None:
+        complete = True
+
+    resume_after = (last_session_id, last_search_term) if last_session_id is not None else None
+    return dataset_id, resume_after, complete
+
+
+def get_failed_sessions(conn, dataset_id):
+    """
+    Get the (session ID, search term) of every session in a dataset that couldn't be inserted
+    """
+    stmt = select([failed_session_table.c.search_session_id, failed_session_table.c.search_term]).where(
+        failed_session_table.c.dataset_id == dataset_id
+    )
+    return {tuple(row) for row in conn.execute(stmt)}
+
+
+def get_dataset_filenames(conn):
+    """
+    Get the filename of every dataset that has been completely loaded
+    """
+    stmt = select([dataset_table.c.filename]).select_from(
+        dataset_table.outerjoin(checkpoint_table)
+    ).where(
+        (checkpoint_table.c.complete == True) | (checkpoint_table.c.dataset_id == None)
+    )
+    return {row[0] for row in conn.execute(stmt)}
+
+
+def is_partitioned(conn, table):
+    """
+    Check whether a table has been partitioned by migrate_database.py
+    """
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    stmt = text('select exists (select 1 from pg_partitioned_table where partrelid = to_regclass(:name))')
+    return conn.execute(stmt, name=table.name).scalar()
+
+
+def create_search_partition(conn, dataset_id, table_name='searches'):
+    """
+    Create the partition of the searches table that holds one dataset
+    """
+    dataset_id = int(dataset_id)
+    conn.execute(text(
+        f'create table if not exists searches_{dataset_id} partition of {table_name} for values in ({dataset_id})'
+    ))
 
 
 def insert_session_into_database(search_session, conn, dataset_id):
     """
     Load a session summary into the database
     """
-    try:
-        stmt = query_table.insert().values(search_term_lowercase=search_session['searchTerm'], normalised_search_term=search_session['normalisedSearchTerm'])
-        result = conn.execute(stmt)
-        query_id = result.inserted_primary_key[0]
-    except IntegrityError:
-        stmt = select([query_table.c.query_id]).where(query_table.c.search_term_lowercase == search_session['searchTerm']).where(query_table.c.normalised_search_term == search_session['normalisedSearchTerm'])
-        result = conn.execute(stmt)
-        query_id = result.fetchone()[0]
-
-    stmt = search_table.insert().values(
-        query_id=query_id,
-        dataset_id=dataset_id,
-        clicked_urls=search_session['clickedResults'],
-        all_urls=search_session['allResults'],
-        final_click_url=search_session['finalItemClicked'],
-        final_click_rank=search_session['finalRank']
-    )
-    conn.execute(stmt)
+    with conn.begin():
+        loader = SessionLoader(conn, dataset_id)
+        query_ids = loader.upsert_queries([search_session])
+        result_ids = loader.upsert_results([search_session])
+        loader.insert_searches([search_session], query_ids, result_ids)
+        loader.update_session_counts([search_session], query_ids)
 
 
-def get_searches(conn):
+class SessionLoader:
     """
-    Get a dataframe containing every search and the final thing clicked
+    Loads session summaries into the database in batches.
+
+    Each batch is written in a single transaction: new queries are created with one
+    upsert, and all the searches are written with one multi-row insert.
+    The same goes for the IDs of result URLs. Query and result IDs are cached in memory,
+    so each one is only looked up once per load.
+
+    The session count of each query is incremented in the same transaction, and
+    queries are marked as high volume once the count passes high_volume_threshold.
+
+    The dataset's checkpoint is also updated with the last session in each batch.
+    To resume a load that was interrupted, pass the checkpoint as resume_after, and
+    any sessions up to and including that one will be skipped. This relies on the
+    sessions being loaded in order, which they are when the input is sorted by session ID.
+
+    Sessions that can't be inserted are recorded in the failed_sessions table, and
+    aren't skipped when resuming, so they are retried. The dataset is only marked as
+    complete once none are left.
+    """
+    def __init__(self, conn, dataset_id, batch_size=BATCH_SIZE, high_volume_threshold=HIGH_VOLUME_THRESHOLD, resume_after=None):
+        self.conn = conn
+        self.dataset_id = dataset_id
+        self.batch_size = batch_size
+        self.high_volume_threshold = high_volume_threshold
+        self.resume_after = tuple(resume_after) if resume_after else None
+        self.loaded_through = self.resume_after
+        self.failed_sessions = get_failed_sessions(conn, dataset_id)
+        self.query_ids = {}
+        self.result_ids = {}
+
+    def load(self, search_sessions, invalid_counter):
+        """
+        Load an iterable of session summaries. Returns the number of sessions inserted.
+        """
+        inserted = 0
+        batch = []
+        for search_session in search_sessions:
+            session_id = tuple(search_session['searchSessionId'])
+            if self.resume_after and session_id <= self.resume_after and session_id not in self.failed_sessions:
+                invalid_counter['already_loaded'] += 1
+                continue
+
+            batch.append(search_session)
+            if len(batch) >= self.batch_size:
+                inserted += self.load_batch(batch, invalid_counter)
+                batch = []
+
+        if batch:
+            inserted += self.load_batch(batch, invalid_counter)
+
+        return inserted
+
+    def load_batch(self, batch, invalid_counter):
+        """
+        Load a batch in one transaction. If that fails, retry each half of it
+        separately, so a bad session only loses itself rather than the whole batch.
+        Returns the number of sessions inserted.
+        """
+        failed = False
+        try:
+            with self.conn.begin():
+                new_query_ids = self.upsert_queries(batch)
+                new_result_ids = self.upsert_results(batch)
+                query_ids = ChainMap(new_query_ids, self.query_ids)
+                self.insert_searches(batch, query_ids, ChainMap(new_result_ids, self.result_ids))
+                self.update_session_counts(batch, query_ids)
+                self.update_checkpoint(batch)
+                retried = self.clear_failed_sessions(batch)
+        except Exception:
+            if len(batch) == 1:
+                logging.exception(f'Unable to insert session {batch[0]["searchSessionId"]} into database')
+                invalid_counter['database_errors'] += 1
+                self.record_failed_session(batch[0])
+                return 0
+
+            logging.warning(f'Unable to insert batch of {len(batch)} sessions into database, retrying it in halves')
+            failed = True
+
+        if failed:
+            middle = len(batch) // 2
+            return self.load_batch(batch[:middle], invalid_counter) + self.load_batch(batch[middle:], invalid_counter)
+
+        # Only cache the IDs once we know the transaction was committed
+        self.query_ids.update(new_query_ids)
+        self.result_ids.update(new_result_ids)
+        self.failed_sessions.difference_update(retried)
+        self.loaded_through = max(self.loaded_through or (), tuple(batch[-1]['searchSessionId']))
+        return len(batch)
+
+    def upsert_queries(self, batch):
+        """
+        Get IDs for any queries in the batch that aren't cached yet, creating any queries
+        that don't exist in the database.
+        """
+        new_queries = {}
+        for search_session in batch:
+            search_term = search_session['searchTerm']
+            if search_term not in self.query_ids:
+                new_queries[search_term] = search_session['normalisedSearchTerm']
+
+        if not new_queries:
+            return {}
+
+        return get_or_create_ids(
+            self.conn,
+            query_table.c.search_term_lowercase,
+            query_table.c.query_id,
+            [
+                {'search_term_lowercase': search_term, 'normalised_search_term': normalised_search_term}
+                for search_term, normalised_search_term in new_queries.items()
+            ]
+        )
+
+    def upsert_results(self, batch):
+        """
+        Get IDs for any result URLs in the batch that aren't cached yet, creating any
+        that don't exist in the database.
+        """
+        new_urls = set()
+        for search_session in batch:
+            new_urls.update(search_session['allResults'])
+            new_urls.update(search_session['clickedResults'])
+            new_urls.add(search_session['finalItemClicked'])
+        new_urls.difference_update(self.result_ids)
+
+        if not new_urls:
+            return {}
+
+        return get_or_create_ids(
+            self.conn,
+            result_table.c.url,
+            result_table.c.result_id,
+            [{'url': url} for url in sorted(new_urls)]
+        )
+
+    def insert_searches(self, batch, query_ids, result_ids):
+        insert_rows(self.conn, search_table, [
+            {
+                'query_id': query_ids[search_session['searchTerm']],
+                'dataset_id': self.dataset_id,
+                'clicked_result_ids': [result_ids[url] for url in search_session['clickedResults']],
+                'all_result_ids': [result_ids[url] for url in search_session['allResults']],
+                'final_click_result_id': result_ids[search_session['finalItemClicked']],
+                'final_click_rank': search_session['finalRank'],
+            }
+            for search_session in batch
+        ])
+
+    def update_checkpoint(self, batch):
+        values = {'sessions_loaded': checkpoint_table.c.sessions_loaded + len(batch)}
+
+        # A batch of retried sessions doesn't move the checkpoint backwards
+        last_session = tuple(batch[-1]['searchSessionId'])
+        if self.loaded_through is None or last_session > self.loaded_through:
+            values['last_session_id'], values['last_search_term'] = last_session
+
+        stmt = checkpoint_table.update().where(checkpoint_table.c.dataset_id == self.dataset_id).values(**values)
+        self.conn.execute(stmt)
+
+    def clear_failed_sessions(self, batch):
+        """
+        Forget about any sessions in the batch that failed before.
+        Returns their (session ID, search term)s.
+        """
+        retried = {tuple(search_session['searchSessionId']) for search_session in batch} & self.failed_sessions
+        if retried:
+            stmt = failed_session_table.delete().where(
+                (failed_session_table.c.dataset_id == self.dataset_id) &
+                (failed_session_table.c.search_session_id == bindparam('failed_session_id')) &
+                (failed_session_table.c.search_term == bindparam('failed_search_term'))
+            )
+            self.conn.execute(stmt, [
+                {'failed_session_id': session_id, 'failed_search_term': search_term}
+                for session_id, search_term in retried
+            ])
+        return retried
+
+    def record_failed_session(self, search_session):
+        """
+        Remember a session that couldn't be inserted, so it's retried when the load is resumed.
+        If this fails too, the load stops, because otherwise resuming would skip the session.
+        """
+        session_id = tuple(search_session['searchSessionId'])
+        if session_id in self.failed_sessions:
+            return
+
+        with self.conn.begin():
+            self.conn.execute(failed_session_table.insert().values(
+                dataset_id=self.dataset_id,
+                search_session_id=session_id[0],
+                search_term=session_id[1],
+            ))
+        self.failed_sessions.add(session_id)
+
+    def resume_point(self):
+        """
+        Get the (session ID, search term) that every session before has already been
+        loaded, or None if there's nothing to skip
+        """
+        if not self.resume_after:
+            return None
+        return min([self.resume_after] + list(self.failed_sessions))
+
+    def finish(self):
+        """
+        Mark the dataset as completely loaded, unless there are sessions that still
+        need to be retried. Returns whether it was marked as complete.
+        """
+        if self.failed_sessions:
+            return False
+
+        stmt = checkpoint_table.update().where(
+            checkpoint_table.c.dataset_id == self.dataset_id
+        ).values(complete=True)
+        self.conn.execute(stmt)
+        return True
+
+    def update_session_counts(self, batch, query_ids):
+        session_counts = Counter(query_ids[search_session['searchTerm']] for search_session in batch)
+
+        # Both SET expressions see the count from before the update
+        new_count = query_table.c.session_count + bindparam('added_sessions')
+        stmt = query_table.update().where(
+            query_table.c.query_id == bindparam('updated_query_id')
+        ).values(
+            session_count=new_count,
+            high_volume=new_count > self.high_volume_threshold
+        )
+
+        self.conn.execute(stmt, [
+            {'updated_query_id': query_id, 'added_sessions': count}
+            for query_id, count in session_counts.items()
+        ])
+
+
+def get_or_create_ids(conn, key_column, id_column, rows):
+    """
+    Insert any rows that don't exist yet, and get the ID of every row.
+    Returns a dictionary mapping the values of key_column, which must be unique, to IDs.
+    """
+    table = key_column.table
+
+    if conn.dialect.name != 'postgresql':
+        conn.execute(table.insert().prefix_with('OR IGNORE'), rows)
+        return lookup_ids(conn, key_column, id_column, [row[key_column.name] for row in rows])
+
+    stmt = upsert(table).values(rows)
+
+    # Updating the conflicting row is a no-op, but unlike DO NOTHING it means
+    # existing rows are returned as well as new ones
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[key_column],
+        set_={key_column.name: getattr(stmt.excluded, key_column.name)}
+    ).returning(key_column, id_column)
+
+    return dict(conn.execute(stmt).fetchall())
+
+
+def lookup_ids(conn, key_column, id_column, keys):
+    """
+    Get a dictionary mapping values of key_column to IDs
+    """
+    ids = {}
+    for start in range(0, len(keys), SQLITE_MAX_PARAMETERS):
+        stmt = select([key_column, id_column]).where(key_column.in_(keys[start:start + SQLITE_MAX_PARAMETERS]))
+        ids.update(conn.execute(stmt).fetchall())
+    return ids
+
+
+def insert_rows(conn, table, rows):
+    """
+    Insert a list of rows as dictionaries.
+
+    Postgres is much faster with a single multi-row insert, but this
+    can have too many parameters for SQLite, so insert them one at a time.
+    """
+    if conn.dialect.name == 'postgresql':
+        conn.execute(table.insert().values(rows))
+    else:
+        conn.execute(table.insert(), rows)
+
+
+def refresh_query_session_counts(conn, threshold=HIGH_VOLUME_THRESHOLD):
+    """
+    Recount the sessions for every query from scratch.
+
+    SessionLoader keeps the counts up to date, so this is only needed for
+    searches that were loaded before the session_count column existed.
+    """
+    session_count = select(
+        [func.count()]
+    ).where(search_table.c.query_id == query_table.c.query_id).as_scalar()
+
+    with conn.begin():
+        conn.execute(query_table.update().values(session_count=session_count))
+        update_high_volume(conn, threshold)
+
+
+def update_high_volume(conn, threshold=HIGH_VOLUME_THRESHOLD):
+    """
+    Mark queries as high volume using the stored session counts.
+    This only reads the queries table, so it's cheap to run if the threshold changes.
+    """
+    conn.execute(query_table.update().values(high_volume=query_table.c.session_count > threshold))
+
+
+def searches_query(dataset_ids=None, queries=None, high_volume_only=True):
+    """
+    Select every search for high volume queries (or every query, if high_volume_only
+    is False), optionally only from some datasets, or for some queries
     """
     stmt = select(
         [
             search_table.c.id,
-            search_table.c.final_click_url,
+            search_table.c.final_click_result_id,
             search_table.c.final_click_rank,
             query_table.c.search_term_lowercase,
 
             # These are arrays
-            search_table.c.all_urls,
-            search_table.c.clicked_urls,
+            search_table.c.all_result_ids,
+            search_table.c.clicked_result_ids,
         ]
     ).select_from(
         search_table.join(query_table)
-    ).where(query_table.c.high_volume == True)
+    )
+
+    if high_volume_only:
+        stmt = stmt.where(query_table.c.high_volume == True)
+
+    if dataset_ids is not None:
+        stmt = stmt.where(search_table.c.dataset_id.in_(dataset_ids))
+
+    if queries is not None:
+        stmt = stmt.where(query_table.c.search_term_lowercase.in_(queries))
 
-    # with foo as (select query_id from queries join searches using (query_id) group by query_id having count(*) > 1000) update queries set high_volume=true from foo where queries.query_id=foo.query_id;
+    return stmt
 
+
+def get_searches(conn, dataset_ids=None, queries=None):
+    """
+    Get a dataframe containing every search and the final thing clicked
+
+    If dataset_ids is set, only get searches from those datasets.
+    If queries is set, only get searches for those queries.
+    """
+    stmt = searches_query(dataset_ids=dataset_ids, queries=queries)
     df = pd.read_sql(stmt, conn, index_col='id')
 
-    return df
+    return decode_result_ids(df, get_result_urls(conn))
+
+
+def stream_searches(conn, chunksize=READ_CHUNKSIZE, dataset_ids=None, queries=None, high_volume_only=True):
+    """
+    Like get_searches, but yield dataframes of at most chunksize searches at a time.
+    Set high_volume_only=False to include searches for every query.
+
+    The rows are read with a server side cursor, so only one chunk is in memory at once
+    (plus the dictionary of result URLs).
+    """
+    urls = get_result_urls(conn)
+    stmt = searches_query(dataset_ids=dataset_ids, queries=queries, high_volume_only=high_volume_only)
+    result = conn.execution_options(stream_results=True).execute(stmt)
+
+    try:
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+
+            df = pd.DataFrame.from_records(rows, columns=result.keys(), index='id')
+            yield decode_result_ids(df, urls)
+    finally:
+        result.close()
+
+
+def get_result_urls(conn):
+    """
+    Get an array of every result URL, indexed by result ID
+    """
+    df = pd.read_sql(select([result_table.c.result_id, result_table.c.url]), conn)
+
+    urls = np.empty(df.result_id.max() + 1 if len(df) else 0, dtype=object)
+    urls[df.result_id.values] = df.url.values
+    return urls
+
+
+def decode_result_ids(df, urls):
+    """
+    Replace the result ID columns of a dataframe of searches with URLs
+    """
+    # If there are no searches the IDs come back as objects, which can't be used as indices
+    df = df.assign(
+        final_click_url=urls[df.final_click_result_id.values.astype(np.int64)],
+        all_urls=[list(urls[result_ids]) for result_ids in df.all_result_ids],
+        clicked_urls=[list(urls[result_ids]) for result_ids in df.clicked_result_ids],
+    )
+    return df[['final_click_url', 'final_click_rank', 'search_term_lowercase', 'all_urls', 'clicked_urls']]
 
 
-def get_skipped_urls(conn):
+def get_skipped_urls(conn, dataset_ids=None, queries=None):
     """
     Get every query/result pair where the result was skipped
+    """
+    return skipped_urls(get_searches(conn, dataset_ids=dataset_ids, queries=queries))
+
+
+def stream_skipped_urls(conn, chunksize=READ_CHUNKSIZE, dataset_ids=None, queries=None):
+    """
+    Yield dataframes of query/result pairs where the result was skipped,
+    for chunksize searches at a time.
 
-    This is done by unnesting everything so we have (session, result, query) tuples,
-    and then excluding any clicked tuples from the passed over tuples.
-    It probably makes sense(?)
+    A result was skipped if it was in all_urls but not in clicked_urls.
     """
-    passed_over = select(
+    for searches in stream_searches(conn, chunksize=chunksize, dataset_ids=dataset_ids, queries=queries):
+        yield skipped_urls(searches)
+
+
+def skipped_urls(searches):
+    """
+    Get every (session, result, query) tuple in a dataframe of searches where the result was skipped
+
+    This used to be an EXCEPT over two unnest queries in the database, but it's much
+    cheaper to work it out from the searches we've already read.
+    """
+    passed_over = unnested_urls(searches, 'all_urls')
+    clicked = unnested_urls(searches, 'clicked_urls')
+
+    passed_over_keys = pd.MultiIndex.from_arrays([passed_over.index, passed_over.result])
+    clicked_keys = pd.MultiIndex.from_arrays([clicked.index, clicked.result])
+
+    # Results can appear more than once in all_urls
+    skipped = ~passed_over_keys.isin(clicked_keys) & ~passed_over_keys.duplicated()
+    return passed_over[skipped]
+
+
+def unnested_urls(searches, column):
+    """
+    Get a dataframe of (session, result, query) tuples for every URL in a list column of searches
+    """
+    lengths = searches[column].map(len).values.astype(np.int64)
+
+    return pd.DataFrame(
+        {
+            'result': [url for urls in searches[column] for url in urls],
+            'search_term_lowercase': np.repeat(searches.search_term_lowercase.values, lengths),
+        },
+        index=pd.Index(np.repeat(searches.index.values, lengths), name='id'),
+        columns=['result', 'search_term_lowercase']
+    )
+
+
+def get_clicked_urls(conn, dataset_ids=None, queries=None):
+    """
+    Get every query/result pair where the result was clicked
+
+    If dataset_ids is set, only get searches from those datasets.
+    If queries is set, only get searches for those queries.
+    """
+    if conn.dialect.name != 'postgresql':
+        # Only Postgres can unnest arrays
+        return unnested_urls(get_searches(conn, dataset_ids=dataset_ids, queries=queries), 'clicked_urls')
+
+    stmt = clicked_urls_query(dataset_ids=dataset_ids, queries=queries)
+
+    return pd.read_sql(stmt, conn, index_col='id')
+
+
+def stream_clicked_urls(conn, chunksize=READ_CHUNKSIZE, dataset_ids=None, queries=None):
+    """
+    Yield dataframes of query/result pairs where the result was clicked,
+    for chunksize searches at a time
+    """
+    for searches in stream_searches(conn, chunksize=chunksize, dataset_ids=dataset_ids, queries=queries):
+        yield unnested_urls(searches, 'clicked_urls')
+
+
+def clicked_urls_query(dataset_ids=None, queries=None):
+    return unnested_urls_query(search_table.c.clicked_result_ids, dataset_ids=dataset_ids, queries=queries)
+
+
+def unnested_urls_query(result_ids_column, dataset_ids=None, queries=None):
+    """
+    Get (session, result, query) tuples for every URL in an array column of searches
+    for high volume queries, optionally only from some datasets, or for some queries
+    """
+    unnested = select(
         [
             search_table.c.id,
-            func.unnest(search_table.c.passed_over_urls).label('result'),
+            search_table.c.query_id,
+            func.unnest(result_ids_column).label('result_id'),
+        ]
+    )
+
+    if dataset_ids is not None:
+        unnested = unnested.where(search_table.c.dataset_id.in_(dataset_ids))
+
+    unnested = unnested.alias('unnested')
+
+    stmt = select(
+        [
+            unnested.c.id,
+            result_table.c.url.label('result'),
             query_table.c.search_term_lowercase,
         ]
     ).select_from(
-        search_table.join(query_table)
+        unnested.join(
+            result_table, unnested.c.result_id == result_table.c.result_id
+        ).join(
+            query_table, unnested.c.query_id == query_table.c.query_id
+        )
     ).where(query_table.c.high_volume == True)
 
-    clicked = clicked_urls_query()
+    if queries is not None:
+        stmt = stmt.where(query_table.c.search_term_lowercase.in_(queries))
 
-    stmt = except_(passed_over, clicked)
+    return stmt
 
-    return pd.read_sql(stmt, conn, index_col='id')
 
+def save_sdbn_counts(conn, dataset_id, counts):
+    """
+    Store the click model counts for a dataset, replacing any that were saved before.
+    counts should be indexed by (query, document), as returned by SimplifiedDBNModel.count
+    """
+    counts = counts.reset_index()
 
-def get_clicked_urls(conn):
+    with conn.begin():
+        query_ids = lookup_ids(
+            conn,
+            query_table.c.search_term_lowercase,
+            query_table.c.query_id,
+            counts['query'].unique().tolist()
+        )
+        result_ids = lookup_ids(
+            conn,
+            result_table.c.url,
+            result_table.c.result_id,
+            counts['document'].unique().tolist()
+        )
+
+        conn.execute(sdbn_count_table.delete().where(sdbn_count_table.c.dataset_id == dataset_id))
+
+        for start in range(0, len(counts), BATCH_SIZE):
+            batch = counts.iloc[start:start + BATCH_SIZE]
+            insert_rows(conn, sdbn_count_table, [
+                {
+                    'dataset_id': dataset_id,
+                    'query_id': query_ids[row.query],
+                    'result_id': result_ids[row.document],
+                    'attr_numerator': int(row.attr_numerator),
+                    'attr_denominator': int(row.attr_denominator),
+                    'sat_numerator': int(row.sat_numerator),
+                    'sat_denominator': int(row.sat_denominator),
+                }
+                for row in batch.itertuples()
+            ])
+
+
+def get_counted_datasets(conn):
     """
-    Get every query/result pair where the result was clicked
+    Get the IDs of every dataset with saved click model counts, oldest first
     """
-    stmt = clicked_urls_query()
+    stmt = select([sdbn_count_table.c.dataset_id]).distinct().order_by(sdbn_count_table.c.dataset_id)
+    return [row[0] for row in conn.execute(stmt)]
 
-    return pd.read_sql(stmt, conn, index_col='id')
 
+def get_sdbn_counts(conn, dataset_ids):
+    """
+    Get the click model counts for some datasets, with one row per (dataset, query, document).
 
-def clicked_urls_query():
-    return select(
+    Counts are saved for every query, but this only returns the ones that are high volume
+    now, so a query that becomes high volume gets the counts from before it did.
+    """
+    stmt = select(
         [
-            search_table.c.id,
-            func.unnest(search_table.c.clicked_urls).label('result'),
-            query_table.c.search_term_lowercase,
+            sdbn_count_table.c.dataset_id,
+            query_table.c.search_term_lowercase.label('query'),
+            sdbn_count_table.c.result_id,
+            sdbn_count_table.c.attr_numerator,
+            sdbn_count_table.c.attr_denominator,
+            sdbn_count_table.c.sat_numerator,
+            sdbn_count_table.c.sat_denominator,
         ]
     ).select_from(
-        search_table.join(query_table)
+        sdbn_count_table.join(query_table)
+    ).where(
+        sdbn_count_table.c.dataset_id.in_(dataset_ids)
     ).where(query_table.c.high_volume == True)
 
+    counts = pd.read_sql(stmt, conn)
+    document = get_result_urls(conn)[counts.result_id.values.astype(np.int64)]
+    counts.insert(2, 'document', document)
+    return counts.drop(columns='result_id')
+
 
 def get_content_items(conn):
     stmt = select(
@@ -4,7 +4,7 @@ Debug models and evaluation code
 What results will my evaluation metric value?
 
 """
-from split_data import load_from_csv
+from split_data import load_from_store
 from database import get_content_items, setup_database
 
 
@@ -18,7 +18,7 @@ if __name__ == '__main__':
     # Subset of queries I'm using to debug stuff
     eyeball_queries = ['apprenticeships', 'self assessment', 'land registry', 'child benefit', 'visa', 'tax credit', 'pension']
 
-    _training, test = load_from_csv()
+    _training, test = load_from_store()
     test = expand_content_ids(test, on='final_click_url')
 
     for query in eyeball_queries:
@@ -0,0 +1,144 @@
+"""
+Integer-encoded search sessions for training and evaluating click models.
+
+Queries and documents are dictionary encoded, and each session becomes one row
+of a (sessions x 20) matrix of document IDs, with a matching matrix of clicks.
+This means click models can be trained with numpy operations over every session
+at once, instead of building Python objects for every search result.
+"""
+from itertools import chain
+import numpy as np
+import pandas as pd
+
+# We show 20 results per page
+RANK_MAX = 20
+
+# Marks an empty slot in the results matrix, for sessions with fewer than RANK_MAX results
+NO_RESULT = -1
+
+
+class EncodedSessions:
+    """
+    A set of search sessions, where:
+
+    - queries is an Index of every query
+    - documents is an Index of every document
+    - query_ids contains the position of each session's query in queries
+    - results contains the position of each displayed document in documents, by rank
+    - clicks is True wherever the document at that rank was clicked
+    """
+    def __init__(self, queries, documents, query_ids, results, clicks):
+        self.queries = queries
+        self.documents = documents
+        self.query_ids = query_ids
+        self.results = results
+        self.clicks = clicks
+
+    def __len__(self):
+        return len(self.query_ids)
+
+    @property
+    def mask(self):
+        """
+        True wherever there is a result at that rank
+        """
+        return self.results != NO_RESULT
+
+    def last_click_ranks(self):
+        """
+        Get the (zero-based) rank of the last click in each session.
+
+        Like PyClick, sessions with no clicks are treated as if the last click
+        was after the final result.
+        """
+        clicks = self.clicks & self.mask
+        last_click = RANK_MAX - 1 - np.argmax(clicks[:, ::-1], axis=1)
+        return np.where(clicks.any(axis=1), last_click, self.mask.sum(axis=1))
+
+    def query_document_pairs(self):
+        """
+        Encode every distinct (query, document) combination.
+
+        Returns a (sessions x 20) matrix of pair IDs (NO_RESULT where there is no result),
+        and the query ID and document ID of each pair.
+        """
+        mask = self.mask
+        keys = self.query_ids.astype(np.int64)[:, np.newaxis] * len(self.documents) + self.results
+        unique_keys, pair_ids = np.unique(keys[mask], return_inverse=True)
+
+        pairs = np.full(self.results.shape, NO_RESULT, dtype=np.int64)
+        pairs[mask] = pair_ids
+
+        pair_query_ids, pair_document_ids = np.divmod(unique_keys, len(self.documents))
+        return pairs, pair_query_ids, pair_document_ids
+
+
+def flatten_lists(lists):
+    """
+    Flatten a sequence of lists into one object array.
+    Returns (items, the row each item came from, the length of each list)
+    """
+    lengths = np.fromiter((len(items) for items in lists), dtype=np.int64, count=len(lists))
+    items = np.empty(lengths.sum(), dtype=object)
+    items[:] = list(chain.from_iterable(lists))
+    return items, np.repeat(np.arange(len(lengths)), lengths), lengths
+
+
+def encode_sessions(searches, counter=None):
+    """
+    Encode a dataframe of searches, as returned by get_searches.
+
+    When I load the data into the database I check that the *ranks* are complete from 1-20.
+    BUT this doesn't mean there are 20 impressions!
+    When a user navigates back and forth between the result page, impressions may be sent
+    again if the page is reloaded. In which case `all_results` will be a multiple of 20.
+    Additionally, if the results *change* between those page views, there will be more than
+    20 unique links stored in all_urls.
+    So here we remove any duplicates and then truncate to 20 links.
+
+    This works on every session's URLs at once, as one flat array. If counter is set,
+    it counts the sessions with exactly 20 URLs (ok_urls) and the ones that had to be
+    deduplicated and truncated (truncated_urls).
+    """
+    query_ids, queries = pd.factorize(searches.search_term_lowercase)
+    n_sessions = len(searches)
+
+    urls, rows, lengths = flatten_lists(searches.all_urls)
+    clicked_urls, clicked_rows, _ = flatten_lists(searches.clicked_urls)
+
+    # Encode each URL within each session as a single integer
+    url_ids, unique_urls = pd.factorize(np.concatenate([urls, clicked_urls]))
+    n_urls = max(len(unique_urls), 1)
+    keys = rows * n_urls + url_ids[:len(urls)]
+    click_keys = clicked_rows * n_urls + url_ids[len(urls):]
+
+    # Keep the first impression of each URL, unless the session has exactly 20
+    complete = lengths == RANK_MAX
+    keep = ~pd.Index(keys).duplicated() | complete[rows]
+    keys, rows = keys[keep], rows[keep]
+
+    # Then truncate each session to the first 20
+    session_starts = np.r_[0, np.cumsum(np.bincount(rows, minlength=n_sessions))]
+    ranks = np.arange(len(rows)) - session_starts[rows]
+    shown = ranks < RANK_MAX
+    keys, rows, ranks = keys[shown], rows[shown], ranks[shown]
+
+    # Documents are numbered in the order they're first shown
+    document_ids, document_url_ids = pd.factorize(keys % n_urls)
+
+    results = np.full((n_sessions, RANK_MAX), NO_RESULT, dtype=np.int32)
+    results[rows, ranks] = document_ids
+    clicks = np.zeros((n_sessions, RANK_MAX), dtype=bool)
+    clicks[rows, ranks] = np.isin(keys, click_keys)
+
+    if counter is not None:
+        counter['ok_urls'] += int(complete.sum())
+        counter['truncated_urls'] += int(n_sessions - complete.sum())
+
+    return EncodedSessions(
+        queries=pd.Index(queries),
+        documents=pd.Index(unique_urls[document_url_ids]),
+        query_ids=query_ids.astype(np.int32),
+        results=results,
+        clicks=clicks
+    )
@@ -0,0 +1,525 @@
+"""
+Estimate the relevance of each document for a query using click models.
+
+These give the same estimates as PyClick's SDBN and DBN models, but they are trained
+on integer-encoded sessions, with the parameters calculated over the whole click
+matrix at once, rather than updating a Python object for every search result.
+
+In the Dynamic Bayesian Network (DBN) model, a user examines results from the top
+until they find one that satisfies them, or they give up.
+- Attractiveness is the probability of clicking a document when it is examined
+- Satisfaction is the probability that the user is satisfied after clicking a document
+- Continuation (gamma) is the probability that an unsatisfied user examines the next result
+- Relevance is attractiveness * satisfaction
+
+The Simplified DBN model assumes gamma is 1, so that everything up to the last click
+was examined, and the parameters can be counted directly.
+"""
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from encoded_sessions import RANK_MAX, NO_RESULT
+from storage import save_arrays, load_arrays
+
+# Version of the binary format written by ClickModel.save
+MODEL_FORMAT_VERSION = 1
+
+PARAM_COLUMNS = ['attr_numerator', 'attr_denominator', 'sat_numerator', 'sat_denominator']
+
+
+class ClickModel:
+    """
+    Base class for models with an attractiveness and satisfaction parameter per
+    (query, document) pair.
+
+    document_params is indexed by (query, document), and stores the numerator
+    and denominator of each parameter, like PyClick does.
+    """
+    # Same prior as PyClick's parameters, so every parameter starts at 1/2
+    PRIOR_NUMERATOR = 1
+    PRIOR_DENOMINATOR = 2
+
+    # Filter out any document that has been examined less than this many times
+    # (the examination count includes the prior, to match PyClick)
+    MIN_EXAMINATIONS = 10
+
+    gamma = 1
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        document_params = pd.read_csv(csv_file, index_col=['query', 'document'], na_filter=False)
+        return cls(document_params)
+
+    @staticmethod
+    def load(directory):
+        """
+        Load a model saved with save().
+
+        This reads the whole model into memory, since document_params is a dataframe and
+        pandas copies the arrays into it anyway. It's still much faster than parsing JSON or
+        CSV. If you only need rankings, a RelevanceIndex can be memory mapped instead.
+        """
+        arrays, strings, metadata = load_arrays(directory, mmap_mode=None)
+        if metadata.get('format_version') != MODEL_FORMAT_VERSION:
+            raise ValueError(f'{directory} is not a version {MODEL_FORMAT_VERSION} model')
+
+        queries = np.asarray(strings['queries'], dtype=object)
+        documents = np.asarray(strings['documents'], dtype=object)
+        index = pd.MultiIndex.from_arrays(
+            [queries[arrays['query_ids']], documents[arrays['document_ids']]],
+            names=['query', 'document']
+        )
+        document_params = pd.DataFrame({column: arrays[column] for column in PARAM_COLUMNS}, index=index, columns=PARAM_COLUMNS)
+
+        model = MODEL_CLASSES[metadata['model']](document_params)
+        model.gamma = metadata['gamma']
+        return model
+
+    def __init__(self, document_params=None):
+        self.document_params = document_params
+
+    def to_csv(self, csv_file):
+        self.document_params.to_csv(csv_file)
+
+    def save(self, directory):
+        """
+        Save the model in a binary format, with dictionary encoded queries and
+        documents, and float32 parameter counts.
+        """
+        query_ids, queries = pd.factorize(self.document_params.index.get_level_values('query'))
+        document_ids, documents = pd.factorize(self.document_params.index.get_level_values('document'))
+
+        arrays = {column: self.document_params[column].values.astype(np.float32) for column in PARAM_COLUMNS}
+        arrays['query_ids'] = query_ids.astype(np.int32)
+        arrays['document_ids'] = document_ids.astype(np.int32)
+
+        save_arrays(
+            directory,
+            arrays,
+            strings={'queries': queries, 'documents': documents},
+            metadata={'format_version': MODEL_FORMAT_VERSION, 'model': type(self).__name__, 'gamma': float(self.gamma)}
+        )
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        Create a model from parameter counts indexed by (query, document)
+        """
+        model = cls()
+        model.set_counts(counts)
+        return model
+
+    def set_counts(self, counts):
+        """
+        Set the parameters from counts indexed by (query, document), adding the prior
+        """
+        self.document_params = counts[PARAM_COLUMNS].copy()
+        self.document_params[['attr_numerator', 'sat_numerator']] += self.PRIOR_NUMERATOR
+        self.document_params[['attr_denominator', 'sat_denominator']] += self.PRIOR_DENOMINATOR
+        self.document_params.sort_index(inplace=True)
+
+    @property
+    def attractiveness(self):
+        return self.document_params.attr_numerator / self.document_params.attr_denominator
+
+    @property
+    def satisfaction(self):
+        return self.document_params.sat_numerator / self.document_params.sat_denominator
+
+    def params(self, query, document):
+        """
+        Get the (attractiveness, satisfaction) of a document.
+        Documents that weren't in the training set get the prior.
+        """
+        try:
+            params = self.document_params.loc[(query, document)]
+        except KeyError:
+            prior = self.PRIOR_NUMERATOR / self.PRIOR_DENOMINATOR
+            return prior, prior
+
+        return (
+            params.attr_numerator / params.attr_denominator,
+            params.sat_numerator / params.sat_denominator
+        )
+
+    def session_params(self, sessions):
+        """
+        Get (sessions x 20) matrices of the attractiveness and satisfaction of every
+        result in a set of EncodedSessions. Documents that weren't in the training set
+        get the prior, and empty slots are 0.
+        """
+        pairs, pair_query_ids, pair_document_ids = sessions.query_document_pairs()
+        index = pd.MultiIndex.from_arrays(
+            [sessions.queries[pair_query_ids], sessions.documents[pair_document_ids]],
+            names=['query', 'document']
+        )
+        params = self.document_params.reindex(index)
+
+        prior = self.PRIOR_NUMERATOR / self.PRIOR_DENOMINATOR
+        attractiveness = (params.attr_numerator / params.attr_denominator).fillna(prior).values
+        satisfaction = (params.sat_numerator / params.sat_denominator).fillna(prior).values
+
+        # Empty slots (NO_RESULT) pick up the 0 on the end
+        return np.r_[attractiveness, 0][pairs], np.r_[satisfaction, 0][pairs]
+
+    def predict_relevance(self, query, document):
+        attractiveness, satisfaction = self.params(query, document)
+        return attractiveness * satisfaction
+
+    def relevance(self, query):
+        """
+        Get the relevance of every document for a query, most relevant first
+        """
+        try:
+            params = self.document_params.loc[query]
+        except KeyError:
+            return pd.Series([], dtype=float)
+
+        params = params[params.attr_denominator >= self.MIN_EXAMINATIONS]
+        relevance = (params.attr_numerator / params.attr_denominator) * (params.sat_numerator / params.sat_denominator)
+        return relevance.sort_values(ascending=False)
+
+    def relevance_table(self):
+        """
+        Get the relevance of every document that has been examined enough times,
+        indexed by (query, document)
+        """
+        params = self.document_params[self.document_params.attr_denominator >= self.MIN_EXAMINATIONS]
+        relevance = (params.attr_numerator / params.attr_denominator) * (params.sat_numerator / params.sat_denominator)
+        return pd.DataFrame({'relevance': relevance, 'examinations': params.attr_denominator})
+
+    def get_conditional_click_probs(self, search_session):
+        """
+        Get the probability of each observed click/non-click given the clicks above it.
+        This is the same interface as PyClick, so we can use PyClick's LogLikelihood.
+        """
+        click_probs = []
+        exam = 1
+        for result in search_session.web_results:
+            attr, sat = self.params(search_session.query, result.id)
+            if result.click:
+                click_prob = attr * exam
+                exam = (1 - sat) * self.gamma
+            else:
+                click_prob = 1 - attr * exam
+                exam *= self.gamma * (1 - attr) / click_prob
+            click_probs.append(click_prob)
+        return click_probs
+
+    def get_full_click_probs(self, search_session):
+        """
+        Get the unconditional probability of a click at each rank.
+        This is the same interface as PyClick, so we can use PyClick's Perplexity.
+        """
+        click_probs = []
+        exam = 1
+        for result in search_session.web_results:
+            attr, sat = self.params(search_session.query, result.id)
+            click_probs.append(attr * exam)
+            exam *= self.gamma * (1 - attr * sat)
+        return click_probs
+
+
+def pair_counts(sessions, pair_query_ids, pair_document_ids, counts):
+    """
+    Make a dataframe of parameter counts for each pair returned by
+    EncodedSessions.query_document_pairs
+    """
+    index = pd.MultiIndex.from_arrays(
+        [sessions.queries[pair_query_ids], sessions.documents[pair_document_ids]],
+        names=['query', 'document']
+    )
+    return pd.DataFrame(counts, index=index, columns=PARAM_COLUMNS)
+
+
+class SimplifiedDBNModel(ClickModel):
+    """
+    The parameters of this model are just ratios of counts, so models trained on
+    different sets of sessions can be combined by adding up their counts.
+    """
+    def train(self, sessions):
+        """
+        Estimate parameters from a set of EncodedSessions
+        """
+        self.set_counts(self.count(sessions))
+        return self
+
+    @staticmethod
+    def count(sessions, weights=None):
+        """
+        Count the clicks and examinations of each (query, document) pair
+        in a set of EncodedSessions, without the prior.
+
+        If weights is set, each session counts that many times (see uncertainty.py)
+        """
+        pairs, pair_query_ids, pair_document_ids = sessions.query_document_pairs()
+        n_pairs = len(pair_query_ids)
+
+        ranks = np.arange(RANK_MAX)
+        last_click_ranks = sessions.last_click_ranks()[:, np.newaxis]
+        mask = sessions.mask
+        clicks = sessions.clicks & mask
+
+        examined = mask & (ranks <= last_click_ranks)
+        last_clicked = clicks & (ranks == last_click_ranks)
+
+        if weights is None:
+            weights = np.ones(len(sessions), dtype=np.int64)
+        weights = np.broadcast_to(np.asarray(weights)[:, np.newaxis], pairs.shape)
+
+        return pair_counts(sessions, pair_query_ids, pair_document_ids, {
+            'attr_numerator': np.bincount(pairs[examined], weights=(weights * clicks)[examined], minlength=n_pairs),
+            'attr_denominator': np.bincount(pairs[examined], weights=weights[examined], minlength=n_pairs),
+            'sat_numerator': np.bincount(pairs[last_clicked], weights=weights[last_clicked], minlength=n_pairs),
+            'sat_denominator': np.bincount(pairs[clicks], weights=weights[clicks], minlength=n_pairs),
+        })
+
+
+class SessionBlock:
+    """
+    A block of sessions for whole queries, which only involves a contiguous
+    range of (query, document) pairs. Pair IDs are relative to the start of the range,
+    so the E-step for each block can run independently.
+    """
+    def __init__(self, pairs, clicks, start, end):
+        self.mask = pairs != NO_RESULT
+        self.pairs = np.where(self.mask, pairs - start, 0)
+        self.clicks = clicks & self.mask
+        self.start = start
+        self.end = end
+
+        # The zero-based rank of the last click in each session, or -1 if there were no clicks
+        last_click = RANK_MAX - 1 - np.argmax(self.clicks[:, ::-1], axis=1)
+        self.last_clicks = np.where(self.clicks.any(axis=1), last_click, -1)
+
+    def __len__(self):
+        return len(self.pairs)
+
+
+def split_into_blocks(sessions, pairs, pair_query_ids, n_blocks):
+    """
+    Split sessions into roughly equal blocks, without splitting up any query
+    """
+    order = np.argsort(sessions.query_ids, kind='mergesort')
+    sorted_query_ids = sessions.query_ids[order]
+    query_starts = np.flatnonzero(np.r_[True, sorted_query_ids[1:] != sorted_query_ids[:-1]])
+
+    targets = np.arange(1, n_blocks) * len(order) // n_blocks
+    cuts = query_starts[np.minimum(np.searchsorted(query_starts, targets), len(query_starts) - 1)]
+    cuts = np.unique(np.r_[0, cuts, len(order)])
+
+    blocks = []
+    for block_start, block_end in zip(cuts[:-1], cuts[1:]):
+        rows = order[block_start:block_end]
+
+        # Pairs are sorted by query, so the block's pairs are contiguous
+        start = np.searchsorted(pair_query_ids, sorted_query_ids[block_start], side='left')
+        end = np.searchsorted(pair_query_ids, sorted_query_ids[block_end - 1], side='right')
+        blocks.append(SessionBlock(pairs[rows], sessions.clicks[rows], start, end))
+
+    return blocks
+
+
+def dbn_e_step(block, attractiveness, satisfaction, gamma):
+    """
+    Calculate the expected parameter counts for a block of sessions, given the current
+    parameters of a DBN model. attractiveness and satisfaction cover the block's range of pairs.
+
+    Before the last click, we know every result was examined and the user wasn't satisfied.
+    After it, we work out the posterior probability of each result being examined, and
+    of the user being satisfied with the last click, given that nothing else was clicked.
+
+    Returns the expected attractiveness and satisfaction numerators for each pair, the
+    numerator and denominator for gamma, and the log-likelihood of the block.
+    """
+    n = len(block)
+    rows = np.arange(n)
+    ranks = np.arange(RANK_MAX)
+    mask = block.mask
+    clicks = block.clicks
+    last = block.last_clicks
+    clicked = last >= 0
+    is_last = ranks == last[:, np.newaxis]
+
+    attr = np.where(mask, attractiveness[block.pairs], 0)
+    sat = np.where(mask, satisfaction[block.pairs], 0)
+
+    # Probability of no clicks from each rank onwards, given the rank was examined
+    no_clicks = np.ones((n, RANK_MAX + 1))
+    for rank in range(RANK_MAX - 1, -1, -1):
+        no_clicks[:, rank] = np.where(
+            mask[:, rank],
+            (1 - attr[:, rank]) * (1 - gamma + gamma * no_clicks[:, rank + 1]),
+            1
+        )
+
+    # Probability of the user not clicking anything after the last click
+    last_attr = np.where(clicked, attr[rows, np.maximum(last, 0)], 1)
+    last_sat = np.where(clicked, sat[rows, np.maximum(last, 0)], 0)
+    no_clicks_after_last = no_clicks[rows, last + 1]
+    tail = np.where(
+        clicked,
+        last_sat + (1 - last_sat) * (1 - gamma + gamma * no_clicks_after_last),
+        no_clicks_after_last
+    )
+    satisfied = last_sat / tail
+
+    # Posterior probability of examining each result
+    exam = np.ones((n, RANK_MAX))
+    running = np.where(clicked, (1 - last_sat) * gamma, 1) / tail
+    for rank in range(RANK_MAX):
+        after_last = rank > last
+        exam[:, rank] = np.where(after_last, running * no_clicks[:, rank], 1)
+        running = np.where(after_last, running * (1 - attr[:, rank]) * gamma, running)
+    exam *= mask
+
+    n_pairs = block.end - block.start
+
+    # Unclicked results were either not examined, or not attractive
+    attr_posterior = np.where(clicks, 1, attr * (1 - exam))
+    attr_numerator = np.bincount(block.pairs[mask], weights=attr_posterior[mask], minlength=n_pairs)
+    sat_numerator = np.bincount(
+        block.pairs[rows[clicked], last[clicked]],
+        weights=satisfied[clicked],
+        minlength=n_pairs
+    )
+
+    # Transitions from one result to the next, given the user was not satisfied
+    continued = exam - is_last * satisfied[:, np.newaxis]
+    gamma_numerator = exam[:, 1:].sum()
+    gamma_denominator = (continued[:, :-1] * mask[:, 1:]).sum()
+
+    before_last = mask & (ranks < last[:, np.newaxis])
+    before_last_probs = np.where(clicks, attr * (1 - sat) * gamma, (1 - attr) * gamma)
+    log_likelihood = (
+        np.log(np.where(before_last, before_last_probs, 1)).sum() +
+        np.log(last_attr).sum() +
+        np.log(tail).sum()
+    )
+
+    return attr_numerator, sat_numerator, gamma_numerator, gamma_denominator, log_likelihood
+
+
+# Blocks of sessions belonging to each pool worker
+_worker_blocks = None
+
+
+def _init_e_step_worker(blocks):
+    global _worker_blocks
+    _worker_blocks = blocks
+
+
+def _run_e_step(args):
+    block_index, attractiveness, satisfaction, gamma = args
+    return dbn_e_step(_worker_blocks[block_index], attractiveness, satisfaction, gamma)
+
+
+class DynamicBayesianNetworkModel(ClickModel):
+    """
+    The full DBN model, trained with expectation maximisation.
+
+    If processes is set, the E-step is split into blocks of queries and run
+    in a pool of worker processes.
+    """
+    def __init__(self, document_params=None, gamma=0.5, tolerance=1e-4, max_iterations=50, processes=None):
+        super().__init__(document_params)
+        self.gamma = gamma
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.processes = processes
+        self.log_likelihoods = []
+
+    def train(self, sessions):
+        """
+        Estimate parameters from a set of EncodedSessions
+        """
+        pairs, pair_query_ids, pair_document_ids = sessions.query_document_pairs()
+        n_pairs = len(pair_query_ids)
+        mask = sessions.mask
+        clicks = sessions.clicks & mask
+
+        # These don't depend on the hidden variables
+        impressions = np.bincount(pairs[mask], minlength=n_pairs)
+        click_counts = np.bincount(pairs[clicks], minlength=n_pairs)
+
+        n_blocks = self.processes * 4 if self.processes else 1
+        blocks = split_into_blocks(sessions, pairs, pair_query_ids, n_blocks)
+
+        if self.processes:
+            with Pool(self.processes, initializer=_init_e_step_worker, initargs=(blocks,)) as pool:
+                attr_numerator, sat_numerator, gamma = self.expectation_maximisation(
+                    blocks, impressions, click_counts, len(sessions),
+                    lambda args: pool.map(_run_e_step, args)
+                )
+        else:
+            attr_numerator, sat_numerator, gamma = self.expectation_maximisation(
+                blocks, impressions, click_counts, len(sessions),
+                lambda args: [dbn_e_step(block, *arg[1:]) for block, arg in zip(blocks, args)]
+            )
+
+        self.gamma = gamma
+        self.set_counts(pair_counts(sessions, pair_query_ids, pair_document_ids, {
+            'attr_numerator': attr_numerator,
+            'attr_denominator': impressions,
+            'sat_numerator': sat_numerator,
+            'sat_denominator': click_counts,
+        }))
+
+        return self
+
+    def expectation_maximisation(self, blocks, impressions, click_counts, n_sessions, run_e_steps):
+        """
+        Update the parameters until the log likelihood stops improving.
+
+        run_e_steps takes a list of (block index, attractiveness, satisfaction, gamma)
+        for every block, and returns the E-step results for each one.
+        Returns (attr_numerator, sat_numerator, gamma)
+        """
+        n_pairs = len(impressions)
+        prior = self.PRIOR_NUMERATOR / self.PRIOR_DENOMINATOR
+        attractiveness = np.full(n_pairs, prior)
+        satisfaction = np.full(n_pairs, prior)
+        gamma = self.gamma
+
+        self.log_likelihoods = []
+        for iteration in range(self.max_iterations):
+            start = time.time()
+            args = [
+                (i, attractiveness[block.start:block.end], satisfaction[block.start:block.end], gamma)
+                for i, block in enumerate(blocks)
+            ]
+            results = run_e_steps(args)
+
+            attr_numerator = np.zeros(n_pairs)
+            sat_numerator = np.zeros(n_pairs)
+            gamma_numerator = 0
+            gamma_denominator = 0
+            log_likelihood = 0
+            for block, (block_attr, block_sat, block_gamma_numerator, block_gamma_denominator, block_ll) in zip(blocks, results):
+                attr_numerator[block.start:block.end] += block_attr
+                sat_numerator[block.start:block.end] += block_sat
+                gamma_numerator += block_gamma_numerator
+                gamma_denominator += block_gamma_denominator
+                log_likelihood += block_ll
+
+            attractiveness = (attr_numerator + self.PRIOR_NUMERATOR) / (impressions + self.PRIOR_DENOMINATOR)
+            satisfaction = (sat_numerator + self.PRIOR_NUMERATOR) / (click_counts + self.PRIOR_DENOMINATOR)
+            gamma = (gamma_numerator + self.PRIOR_NUMERATOR) / (gamma_denominator + self.PRIOR_DENOMINATOR)
+
+            log_likelihood /= n_sessions
+            end = time.time()
+            print("\tIteration %d: log-likelihood: %f; gamma: %f; time: %i secs" % (iteration + 1, log_likelihood, gamma, end - start))
+
+            converged = len(self.log_likelihoods) > 0 and abs(log_likelihood - self.log_likelihoods[-1]) < self.tolerance
+            self.log_likelihoods.append(log_likelihood)
+            if converged:
+                break
+
+        return attr_numerator, sat_numerator, gamma
+
+
+MODEL_CLASSES = {
+    model_class.__name__: model_class
+    for model_class in (SimplifiedDBNModel, DynamicBayesianNetworkModel)
+}
@@ -1,72 +1,73 @@
 """
-Use PyClick to train a Simplified DBN model and a full DBN model
+Train a Simplified DBN model and a full DBN model
 and compare the results of the two models
+
+The models are trained and evaluated on integer-encoded sessions, using the same
+log likelihood and perplexity as PyClick.
 """
-from pyclick.click_models.Evaluation import LogLikelihood, Perplexity
-from pyclick.click_models.DBN import DBN
-from pyclick.click_models.SDBN import SDBN
-from pyclick.utils.Utils import Utils
-from pyclick.click_models.task_centric.TaskCentricSearchSession import TaskCentricSearchSession
-from pyclick.search_session.SearchResult import SearchResult
-from split_data import load_from_csv
+from split_data import load_stores
 import time
 import logging
-import pyclick.click_models.Evaluation
-from collections import OrderedDict, Counter
+from multiprocessing import cpu_count
+from collections import Counter
 import pandas as pd
-from evaluate_model import ModelTester, QueryDocumentRanker
+from evaluate_model import ModelTester, QueryDocumentRanker, CounterfactualTester
 from debug import expand_content_ids
+from estimate_relevance import SimplifiedDBNModel, DynamicBayesianNetworkModel
+from relevance_index import RelevanceIndex
+from fit_evaluation import evaluate_fit as evaluate_click_probabilities
+from encoded_sessions import RANK_MAX, NO_RESULT, encode_sessions
 
-# Override constant for the page size: we show 20 results per page
-# so start by evaluating all of these.
-# TODO: Do we get worse results by incluuding the bottom 10 links?
-pyclick.click_models.Evaluation.RANK_MAX = 20
-
-sdbn_click_model = SDBN()
-dbn_click_model = DBN()
+sdbn_click_model = SimplifiedDBNModel()
+dbn_click_model = DynamicBayesianNetworkModel(processes=cpu_count())
 
 
-def map_to_pyclick_format(searches):
+class PyClickSessions:
     """
-    Turn my dataframe into a format that can be processed by PyClick
+    The sessions in a set of EncodedSessions, as PyClick TaskCentricSearchSessions.
+
+    Each session is only built when it's accessed, so this is cheap to create, and
+    only costs anything if a PyClick model or metric actually uses it. PyClick is only
+    imported then too, so the rest of this script doesn't need it.
     """
-    sessions = []
-    counter = Counter()
+    def __init__(self, sessions):
+        self.sessions = sessions
 
-    for search in searches.itertuples():
+    def __len__(self):
+        return len(self.sessions)
 
-        query = search.search_term_lowercase
+    def __getitem__(self, i):
+        from pyclick.click_models.task_centric.TaskCentricSearchSession import TaskCentricSearchSession
+        from pyclick.search_session.SearchResult import SearchResult
 
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        query = self.sessions.queries[self.sessions.query_ids[i]]
         session = TaskCentricSearchSession(query, query)
 
-        if len(search.all_urls) != 20:
-            # When I load the data into the database I check that the *ranks* are complete from 1-20.
-            # BUT this doesn't mean there are 20 impressions!
-            # When a user navigates back and forth between the result page, impressions may be sent
-            # again if the page is reloaded. In which case `all_results` will be a multiple of 20.
-            # Additionally, if the results *change* between those page views, there will be more than
-            # 20 unique links stored in all_urls.
-            # My existing code sort of merges this into one uber result set, but PyClick crashes
-            # if a session contains more URLs than RANK_MAX. So here we remove any duplicates and then
-            # truncate to 20 links.
-            unique_links = list(OrderedDict((k, k) for k in search.all_urls).keys())
-            counter['truncated_urls'] += 1
-        else:
-            unique_links = search.all_urls
-            counter['ok_urls'] += 1
-
-        for url in unique_links[:20]:
-            if url in search.clicked_urls:
-                result = SearchResult(url, 1)
-            else:
-                result = SearchResult(url, 0)
-            session.web_results.append(result)
-
-        sessions.append(session)
+        for document, click in zip(self.sessions.results[i], self.sessions.clicks[i]):
+            if document == NO_RESULT:
+                break
+            session.web_results.append(SearchResult(self.sessions.documents[document], int(click)))
 
+        return session
 
-    print(counter)
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def map_to_pyclick_format(searches):
+    """
+    Turn my dataframe into a format that can be processed by PyClick.
 
+    PyClick crashes if a session contains more URLs than RANK_MAX, so encode_sessions
+    removes any duplicates and truncates to 20 links.
+    """
+    counter = Counter()
+    sessions = PyClickSessions(encode_sessions(searches, counter=counter))
+    print(counter)
     return sessions
 
 
@@ -76,7 +77,6 @@ def train_model(model, train_sessions, train_queries):
     print("===============================")
     start = time.time()
     model.train(train_sessions)
-    print(sdbn_click_model.params[sdbn_click_model.param_names.attr].get('apprenticeships', '45ad868a-2e79-4029-991b-c29559d7eb29')._denominator)
     end = time.time()
     print("\tTrained %s click model in %i secs:\n%r" % (model.__class__.__name__, end - start, model))
 
@@ -84,72 +84,64 @@ def train_model(model, train_sessions, train_queries):
 def evaluate_fit(trained_model, test_sessions, test_queries):
     """
     Evaluate the model's fit to the observed data - i.e. whether C==0 or C==1 for every
-    item/session.
-
-    There are two measures:
+    item/session. See fit_evaluation.py for what the measures mean.
 
-    - Log likelihood goes from negative infinity (bad) to 0 (good)
-    - It measures the likelihood of observing the clicks in all the test sessions if the model is correct
-    - Perplexity goes from 1 (good) to 2 (bad).
-    - It's a measure of how surprised we are about all clicks and non-clicks in all of the test sessions if the model is correct.
-    - When comparing models you can use perplexity gain (pB - pA) / (pB - 1)
-    - It can be computed at individual ranks, or averaged across all ranks. Perplexity is normally higher for higher ranks.
+    We show 20 results per page, so this evaluates all of these.
+    TODO: Do we get worse results by incluuding the bottom 10 links?
     """
     print("-------------------------------")
     print("Testing on %d search sessions (%d unique queries)." % (len(test_sessions), len(test_queries)))
     print("-------------------------------")
 
-    loglikelihood = LogLikelihood()
-    perplexity = Perplexity()
-
     start = time.time()
-    ll_value = loglikelihood.evaluate(trained_model, test_sessions)
+    evaluation = evaluate_click_probabilities(trained_model, test_sessions, processes=cpu_count())
     end = time.time()
-    print("\tlog-likelihood: %f; time: %i secs" % (ll_value, end - start))
+    print("\tlog-likelihood: %f; perplexity: %f; time: %i secs" % (evaluation.log_likelihood, evaluation.perplexity, end - start))
+    for rank in range(RANK_MAX):
+        print("\t\tperplexity at rank %d: %f" % (rank + 1, evaluation.perplexity_at_rank[rank]))
 
-    start = time.time()
-    perp_value = perplexity.evaluate(trained_model, test_sessions)[0]
-    end = time.time()
-    print("\tperplexity: %f; time: %i secs" % (perp_value, end - start))
+    return evaluation
 
 
 def debug(model, query):
     """
     Print out model params for each result ordered by the model's ranking
     """
-    ranker = QueryDocumentRanker(PyClickModelAdapter(model))
+    ranker = QueryDocumentRanker(model)
     df = expand_content_ids(ranker.rank(query).to_frame()).sort_values(0)
     for idx, row in df.iterrows():
-        a = sdbn_click_model.params[sdbn_click_model.param_names.attr].get(query, idx)
-        s = sdbn_click_model.params[sdbn_click_model.param_names.sat].get(query, idx)
-        n = sdbn_click_model.params[sdbn_click_model.param_names.attr]._container[query][idx]._denominator
+        a, s = model.params(query, idx)
+        n = model.document_params.loc[(query, idx)].attr_denominator
         print(f'a={a} s={s}, n={n}: {idx} ({row["title"]})')
 
 
 if __name__ == "__main__":
     logging.basicConfig(filename='estimate_with_pyclick.log',level=logging.INFO)
 
-    training, test = load_from_csv()
-    train_sessions = map_to_pyclick_format(training)
-    test_sessions = map_to_pyclick_format(test)
-    train_queries = Utils.get_unique_queries(train_sessions)
+    training, test_store = load_stores()
+    test = test_store.to_frame()
+    train_sessions = training.encoded()
+    test_sessions = test_store.encoded()
+    train_queries = set(train_sessions.queries)
+    test_queries = set(test_sessions.queries)
 
     # PyClick normally filters out any test sessions that aren't in the training set.
     # I shouldn't need to do this, because my train/test split shouldn't let this happen.
-    assert len(test_sessions) == len(Utils.filter_sessions(test_sessions, train_queries))
-
-    test_queries = Utils.get_unique_queries(test_sessions)
+    assert test_queries <= train_queries
 
     print('SDBN')
     train_model(sdbn_click_model, train_sessions, train_queries)
     evaluate_fit(sdbn_click_model, test_sessions, test_queries)
 
-    with open('sdbn_model.json', 'w') as f:
-        f.write(sdbn_click_model.to_json())
+    sdbn_click_model.save('data/sdbn_model')
+    relevance_index = RelevanceIndex.build(sdbn_click_model)
+    relevance_index.save('data/sdbn_relevance_index')
 
-    from evaluate_model import PyClickModelAdapter, QueryDocumentRanker
+    print('DBN')
+    train_model(dbn_click_model, train_sessions, train_queries)
+    evaluate_fit(dbn_click_model, test_sessions, test_queries)
 
-    ranker = QueryDocumentRanker(PyClickModelAdapter(sdbn_click_model))
+    ranker = QueryDocumentRanker(relevance_index)
     tester = ModelTester(ranker)
     evaluation = tester.evaluate(test)
 
@@ -162,6 +154,11 @@ if __name__ == "__main__":
     print(f'Worsened sessions: {worsened}')
     print(f'No change sessions: {no_change}')
 
+    # Position bias corrected metrics, using the click model's examination probabilities
+    counterfactual = CounterfactualTester(ranker, sdbn_click_model, seed=0).evaluate(test.copy())
+    for metric, value in CounterfactualTester.summarise(counterfactual).items():
+        print(f'{metric}: {value}')
+
     #print(f'Mean saved clicks: {evaluation.saved_clicks.mean()}')
 
     debug(sdbn_click_model, 'apprenticeships')
\ No newline at end of file
@@ -9,13 +9,13 @@ import numpy as np
 import sys
 import os
 import logging
+from itertools import chain
+from collections import OrderedDict
 from database import setup_database, get_searches, get_content_items, get_clicked_urls, get_skipped_urls
-from sklearn.model_selection import train_test_split
-from checks import SeriesProperties, DataFrameChecker
-from uncertainty import product_relative_error, ratio_relative_error, sum_error
 from clean_data_from_bigquery import normalise_search_terms
-from estimate_relevance import SimplifiedDBNModel
-from pyclick.click_models import SDBN
+from estimate_relevance import SimplifiedDBNModel, PARAM_COLUMNS
+from relevance_index import RelevanceIndex
+from encoded_sessions import RANK_MAX, NO_RESULT, encode_sessions
 
 logging.basicConfig(filename='estimate_relevance.log',level=logging.INFO)
 
@@ -27,6 +27,9 @@ class PyClickModelAdapter:
     """
     @staticmethod
     def from_json(json_file):
+        # Only needed to convert old models, so don't require pyclick for anything else
+        from pyclick.click_models.SDBN import SDBN
+
         model = SDBN()
         with open(json_file) as f:
             json_str = f.read()
@@ -52,27 +55,98 @@ class PyClickModelAdapter:
             index=documents
         ).sort_values(ascending=False)
 
+    def relevance_table(self):
+        """
+        Get the relevance of every document that has been examined at least 10 times,
+        indexed by (query, document)
+        """
+        container = self.model.params[self.model.param_names.attr]._container
+        rows = []
+        for query, documents in container.items():
+            for document, param in documents.items():
+                if param._denominator >= 10:
+                    rows.append((query, document, self.model.predict_relevance(query, document), param._denominator))
+
+        table = pd.DataFrame(rows, columns=['query', 'document', 'relevance', 'examinations'])
+        return table.set_index(['query', 'document'])
+
+    def to_click_model(self):
+        """
+        Copy the parameters of a PyClick SDBN model into a SimplifiedDBNModel
+        """
+        attr_container = self.model.params[self.model.param_names.attr]._container
+        sat_container = self.model.params[self.model.param_names.sat]._container
+        prior = SimplifiedDBNModel.PRIOR_NUMERATOR, SimplifiedDBNModel.PRIOR_DENOMINATOR
+
+        rows = []
+        for query, documents in attr_container.items():
+            for document, attr in documents.items():
+                try:
+                    sat = sat_container[query][document]
+                    sat_counts = sat._numerator, sat._denominator
+                except KeyError:
+                    # Never clicked
+                    sat_counts = prior
+                rows.append((query, document, attr._numerator, attr._denominator) + tuple(sat_counts))
+
+        document_params = pd.DataFrame(rows, columns=['query', 'document'] + PARAM_COLUMNS)
+        document_params = document_params.set_index(['query', 'document']).sort_index()
+        return SimplifiedDBNModel(document_params)
+
 
 class QueryDocumentRanker:
     """
     Generates new rankings for queries based on a model that estimates relevance
-    of each document. All rankings are cached in memory.
+    of each document, or a precomputed RelevanceIndex.
+
+    Rankings are cached in memory. By default all of them are kept, but if cache_size
+    is set, only that many of the most recently used rankings are kept.
     """
-    def __init__(self, trained_model):
+    def __init__(self, trained_model, cache_size=None):
         self.model = trained_model
-        self.query_rankings = {}
+        self.cache_size = cache_size
+        self.query_rankings = OrderedDict()
 
     def rank(self, query):
         """
         Rank all results for a query by relevance
         """
         try:
-            return self.query_rankings[query]
+            ranking = self.query_rankings[query]
         except KeyError:
-            ranking = self.model.relevance(query).rank(method= 'min', ascending=False)
+            if isinstance(self.model, RelevanceIndex):
+                ranking = self.model.ranking(query)
+            else:
+                ranking = self.model.relevance(query).rank(method= 'min', ascending=False)
+
             self.query_rankings[query] = ranking
+            if self.cache_size is not None and len(self.query_rankings) > self.cache_size:
+                self.query_rankings.popitem(last=False)
             return ranking
 
+        if self.cache_size is not None:
+            self.query_rankings.move_to_end(query)
+        return ranking
+
+    def rankings(self, queries):
+        """
+        Rank all results for several queries.
+        Returns a series of new ranks indexed by (query, document)
+        """
+        if isinstance(self.model, RelevanceIndex):
+            return self.model.rankings(queries)
+
+        rankings = [self.rank(query) for query in queries]
+        index = pd.MultiIndex.from_arrays(
+            [
+                np.repeat(np.asarray(queries, dtype=object), [len(ranking) for ranking in rankings]),
+                np.concatenate([np.asarray(ranking.index, dtype=object) for ranking in rankings] + [np.array([], dtype=object)])
+            ],
+            names=['query', 'document']
+        )
+        values = np.concatenate([np.asarray(ranking.values, dtype=float) for ranking in rankings] + [np.array([])])
+        return pd.Series(values, index=index)
+
 
 class ModelTester:
     def __init__(self, ranker):
@@ -90,9 +164,39 @@ class ModelTester:
         return self._evaluate(test_set)
 
     def _evaluate(self, test_set):
+        """
+        Calculate both metrics for every row at once, by looking up the new rank of
+        every final click and every other click in a table of rankings for all the queries.
+
+        This gives the same results as count_saved_clicks and change_in_rank_of_preferred_document.
+        """
         # TODO: make sure training set contains the same queries as the test set(!)
-        test_set['saved_clicks'] = test_set.apply(self.count_saved_clicks, axis=1)
-        test_set['change_in_rank'] = test_set.apply(self.change_in_rank_of_preferred_document, axis=1)
+        queries = test_set.search_term_lowercase.values
+        new_ranks = self.ranker.rankings(pd.unique(queries))
+
+        # Documents that aren't in the new ranking get NaN, which makes every comparison false
+        final_click_new_ranks = new_ranks.reindex(
+            pd.MultiIndex.from_arrays([queries, test_set.final_click_url.values])
+        ).values
+
+        # Since the doc didn't appear in the training set, we are not
+        # really saying anything about its new rank. So just ignore it.
+        change_in_rank = test_set.final_click_rank.values - final_click_new_ranks
+        change_in_rank = np.where(np.isnan(change_in_rank), 0, change_in_rank)
+
+        # One row for every click, apart from the final clicks
+        click_counts = test_set.clicked_urls.map(len).values
+        click_rows = np.repeat(np.arange(len(test_set)), click_counts)
+        clicked_urls = np.array(list(chain.from_iterable(test_set.clicked_urls)), dtype=object)
+        rubbish = clicked_urls != test_set.final_click_url.values[click_rows]
+        click_rows = click_rows[rubbish]
+
+        click_new_ranks = new_ranks.reindex(
+            pd.MultiIndex.from_arrays([queries[click_rows], clicked_urls[rubbish]])
+        ).values
+        saved = click_new_ranks > final_click_new_ranks[click_rows]
+        test_set['saved_clicks'] = np.bincount(click_rows[saved], minlength=len(test_set))
+        test_set['change_in_rank'] = change_in_rank
 
         return test_set
 
@@ -165,11 +269,172 @@ class ModelTester:
         return (old_rank - new_rank)
 
 
+def examination_probabilities(attractiveness, satisfaction, gamma):
+    """
+    Get the probability that each result in a (sessions x 20) matrix is examined,
+    under a DBN model: the user examines the first result, and continues to the next
+    result with probability gamma unless they were satisfied.
+    """
+    continue_probs = gamma * (1 - attractiveness * satisfaction)
+    exam = np.ones(attractiveness.shape)
+    exam[:, 1:] = np.cumprod(continue_probs[:, :-1], axis=1)
+    return exam
+
+
+def team_draft_interleave(original_order, new_order, lengths, random_state):
+    """
+    Interleave two rankings of the same results for every session at once.
+
+    original_order and new_order are (sessions x 20) matrices of positions in each
+    session's results, in the order each ranking shows them.
+
+    At each step, the team that has contributed fewer results picks next (or a random
+    team, if they've contributed the same number), and adds its highest ranked result
+    that isn't already in the list.
+
+    Returns the interleaved positions, and whether each one came from the new ranking.
+    """
+    n, n_ranks = original_order.shape
+    rows = np.arange(n)
+    interleaved = np.zeros((n, n_ranks), dtype=np.int64)
+    from_new = np.zeros((n, n_ranks), dtype=bool)
+    used = np.zeros((n, n_ranks), dtype=bool)
+    pointers = np.zeros((2, n), dtype=np.int64)
+    picked = np.zeros((2, n), dtype=np.int64)
+
+    for step in range(n_ranks):
+        active = step < lengths
+        coin = random_state.random_sample(n) < 0.5
+        new_team = (picked[1] < picked[0]) | ((picked[1] == picked[0]) & coin)
+        team = new_team.astype(np.int64)
+
+        # Skip over anything the other team already picked
+        for _ in range(n_ranks):
+            pointer = np.minimum(pointers[team, rows], n_ranks - 1)
+            candidate = np.where(new_team, new_order[rows, pointer], original_order[rows, pointer])
+            skip = active & used[rows, candidate]
+            if not skip.any():
+                break
+            pointers[team[skip], rows[skip]] += 1
+
+        interleaved[active, step] = candidate[active]
+        from_new[active, step] = new_team[active]
+        used[rows[active], candidate[active]] = True
+        pointers[team[active], rows[active]] += 1
+        picked[team[active], rows[active]] += 1
+
+    return interleaved, from_new
+
+
+class CounterfactualTester:
+    """
+    Estimate how users would have responded to the new ranking of each test session,
+    correcting for the position bias in the original ranking.
+
+    Like ModelTester, the final click is taken to be the user's preferred document.
+    The new ranking reorders the results the user saw: results the model has a rank for
+    come first, in the model's order, followed by the rest in their original order.
+
+    This calculates two metrics:
+    - Inverse propensity scored (IPS) DCG of the preferred document, in the original
+      and new rankings. The preferred document was only clicked if the user examined it,
+      so each session is weighted by 1 / the probability of examining it at its original
+      rank, according to the click model. Propensities are clipped at min_propensity,
+      which trades a little bias for a lot less variance.
+    - Simulated team-draft interleaving of the original and new rankings. The ranking
+      that contributed the preferred document to the interleaved list wins the session.
+      Only the preferred document counts: the other clicks were on results the user
+      wasn't satisfied with, so crediting them would reward whichever ranking put those
+      higher. Sessions are weighted by the same inverse propensities as the IPS DCG,
+      otherwise the original ranking gets credit for the position bias that put the
+      preferred document in front of the user in the first place.
+    """
+    def __init__(self, ranker, click_model, min_propensity=0.05, seed=None):
+        self.ranker = ranker
+        self.click_model = click_model
+        self.min_propensity = min_propensity
+        self.seed = seed
+
+    def new_positions(self, sessions):
+        """
+        Get the (sessions x 20) matrix of the order the new ranking shows each session's results in
+        """
+        pairs, pair_query_ids, pair_document_ids = sessions.query_document_pairs()
+        index = pd.MultiIndex.from_arrays([sessions.queries[pair_query_ids], sessions.documents[pair_document_ids]])
+        new_ranks = self.ranker.rankings(sessions.queries).reindex(index).values.astype(float)
+
+        # Unranked results go after the ranked ones, and empty slots go last
+        original_ranks = np.arange(RANK_MAX)
+        new_ranks = np.where(np.isnan(new_ranks), np.inf, new_ranks)
+        sort_keys = np.where(pairs == NO_RESULT, np.inf, np.r_[new_ranks, 0][pairs])
+        return np.lexsort((np.broadcast_to(original_ranks, pairs.shape), sort_keys), axis=1)
+
+    def evaluate(self, test_set):
+        """
+        Add the IPS DCG of the original and new rankings, the inverse propensity weight,
+        and the interleaving winner (1 if the new ranking won, -1 if it lost, 0 if there
+        was no preferred document) to each test session
+        """
+        sessions = encode_sessions(test_set)
+        n = len(sessions)
+        rows = np.arange(n)
+        lengths = sessions.mask.sum(axis=1)
+        clicks = sessions.clicks & sessions.mask
+
+        new_order = self.new_positions(sessions)
+        new_ranks = np.empty_like(new_order)
+        new_ranks[rows[:, np.newaxis], new_order] = np.arange(RANK_MAX)
+
+        # The final click should always be on the first page
+        final_click_ids = sessions.documents.get_indexer(test_set.final_click_url)
+        is_final_click = clicks & (sessions.results == final_click_ids[:, np.newaxis])
+        final_slots = np.argmax(is_final_click, axis=1)
+        has_final_click = is_final_click.any(axis=1)
+
+        attractiveness, satisfaction = self.click_model.session_params(sessions)
+        propensities = examination_probabilities(attractiveness, satisfaction, self.click_model.gamma)[rows, final_slots]
+        weights = np.where(has_final_click, 1 / np.maximum(propensities, self.min_propensity), 0)
+
+        test_set['ips_weight'] = weights
+        test_set['ips_original'] = weights / np.log2(final_slots + 2)
+        test_set['ips_new'] = weights / np.log2(new_ranks[rows, final_slots] + 2)
+
+        original_order = np.broadcast_to(np.arange(RANK_MAX), new_order.shape)
+        interleaved, from_new = team_draft_interleave(original_order, new_order, lengths, np.random.RandomState(self.seed))
+
+        # The preferred document is always somewhere in the interleaved list
+        preferred_from_new = from_new[rows, np.argmax(interleaved == final_slots[:, np.newaxis], axis=1)]
+        test_set['interleaving_winner'] = np.where(has_final_click, np.where(preferred_from_new, 1, -1), 0)
+
+        return test_set
+
+    @staticmethod
+    def summarise(evaluation):
+        """
+        Summarise the metrics for every session
+        """
+        winners = evaluation.interleaving_winner
+        wins, losses = (winners > 0).sum(), (winners < 0).sum()
+        total_weight = (evaluation.ips_original > 0).sum()
+        total_ips_weight = evaluation.ips_weight.sum()
+
+        return {
+            'ips_original': evaluation.ips_original.sum() / max(total_weight, 1),
+            'ips_new': evaluation.ips_new.sum() / max(total_weight, 1),
+            'interleaving_wins': wins,
+            'interleaving_losses': losses,
+            'interleaving_ties': (winners == 0).sum(),
+            # Positive if the new ranking is preferred
+            'interleaving_preference': 0.5 * (evaluation.ips_weight * winners).sum() / total_ips_weight if total_ips_weight else 0.0,
+        }
+
+
 if __name__ == '__main__':
     conn = setup_database()
     content_items = get_content_items(conn)
 
-    pyclick_model = PyClickModelAdapter.from_json('data/june10/sdbn_model2.json')
+    # Convert this with convert_model.py first
+    pyclick_model = SimplifiedDBNModel.load('data/june10/sdbn_model2')
 
     # NOTE: this comes from an earlier version of the db because I broke the code
     # by changing the schema
@@ -201,7 +466,7 @@ if __name__ == '__main__':
 
             try:
                 rank2 = pyclick_rank[content_item]
-                examined = pyclick_model.model.params[pyclick_model.model.param_names.attr].get(query, content_item)._denominator
+                examined = pyclick_model.document_params.loc[(query, content_item)].attr_denominator
             except Exception:
                 rank2 = '?'
                 examined = '?'
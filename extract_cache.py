@@ -0,0 +1,65 @@
+"""
+A local cache of query results from bigquery (or a stand-in for it, see local_bigquery.py).
+
+Results are cached for each day separately, as compressed parquet files named
+after the query and the date, so fetching a date range only queries the days we
+haven't already got. Re-running an experiment over the same dates doesn't query
+bigquery at all.
+
+A source is anything with:
+- a name, which identifies where the data comes from
+- a query_template, with {start_date} and {end_date} placeholders
+- a read(query) method, which runs a query and returns a dataframe
+"""
+import hashlib
+import os
+from datetime import timedelta
+import pandas as pd
+
+CACHE_DIR = os.environ.get('EXTRACT_CACHE_DIR', 'data/extract_cache')
+
+
+class ExtractCache:
+    def __init__(self, source, directory=CACHE_DIR):
+        self.source = source
+        self.directory = directory
+
+    @property
+    def query_directory(self):
+        """
+        Results of the same query from the same source are stored together.
+        If the query changes, the old results are ignored.
+        """
+        key = f'{self.source.name}\n{self.source.query_template}'.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest()[:16])
+
+    def path(self, day):
+        return os.path.join(self.query_directory, f'{day:%Y%m%d}.parquet')
+
+    def is_cached(self, day):
+        return os.path.exists(self.path(day))
+
+    def fetch(self, day):
+        """
+        Get the results for one day, querying the source if they aren't cached yet
+        """
+        path = self.path(day)
+        if os.path.exists(path):
+            return pd.read_parquet(path)
+
+        query = self.source.query_template.format(start_date=day, end_date=day)
+        df = self.source.read(query)
+
+        # Write to a temporary file first, so an interrupted write is never mistaken for a cached result
+        os.makedirs(self.query_directory, exist_ok=True)
+        df.to_parquet(path + '.tmp', compression='snappy', index=False)
+        os.replace(path + '.tmp', path)
+
+        return df
+
+    def fetch_range(self, start_date, end_date):
+        """
+        Get the results for every day from start_date to end_date (inclusive)
+        """
+        days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        return pd.concat([self.fetch(day) for day in days], ignore_index=True)
@@ -0,0 +1,115 @@
+"""
+Evaluate how well a click model fits a set of held-out sessions.
+
+This gives the same numbers as PyClick's LogLikelihood and Perplexity, but works on
+integer-encoded sessions, and calculates both in a single pass over the (sessions x 20)
+click matrix, one rank at a time, instead of walking through every session in Python.
+
+- Log likelihood goes from negative infinity (bad) to 0 (good)
+- It measures the likelihood of observing the clicks in all the test sessions if the model is correct
+- Perplexity goes from 1 (good) to 2 (bad).
+- It's a measure of how surprised we are about all clicks and non-clicks in all of the test sessions if the model is correct.
+- When comparing models you can use perplexity gain (pB - pA) / (pB - 1)
+- It can be computed at individual ranks, or averaged across all ranks. Perplexity is normally higher for higher ranks.
+"""
+from collections import namedtuple
+from multiprocessing import Pool
+import numpy as np
+from encoded_sessions import RANK_MAX
+
+FitEvaluation = namedtuple('FitEvaluation', ['log_likelihood', 'perplexity', 'perplexity_at_rank'])
+
+
+def click_probabilities(attractiveness, satisfaction, clicks, mask, gamma):
+    """
+    Calculate the probabilities of a (sessions x 20) matrix of clicks under a DBN model,
+    given the attractiveness and satisfaction of each result.
+
+    Returns two matrices:
+    - conditional: the probability of each observed click/non-click given the clicks above it
+      (the same as ClickModel.get_conditional_click_probs)
+    - full: the unconditional probability of a click at each rank
+      (the same as ClickModel.get_full_click_probs)
+
+    Where there is no result, conditional is 1 and full is 0.
+    """
+    n = len(clicks)
+    conditional = np.ones((n, RANK_MAX))
+    full = np.zeros((n, RANK_MAX))
+    conditional_exam = np.ones(n)
+    full_exam = np.ones(n)
+
+    for rank in range(RANK_MAX):
+        attr = attractiveness[:, rank]
+        sat = satisfaction[:, rank]
+        click = clicks[:, rank]
+        present = mask[:, rank]
+
+        click_prob = np.where(click, attr * conditional_exam, 1 - attr * conditional_exam)
+        conditional[:, rank] = np.where(present, click_prob, 1)
+        conditional_exam = np.where(
+            present,
+            np.where(click, (1 - sat) * gamma, conditional_exam * gamma * (1 - attr) / click_prob),
+            conditional_exam
+        )
+
+        full[:, rank] = np.where(present, attr * full_exam, 0)
+        full_exam = np.where(present, full_exam * gamma * (1 - attr * sat), full_exam)
+
+    return conditional, full
+
+
+def fit_statistics(attractiveness, satisfaction, clicks, mask, gamma):
+    """
+    Calculate the sums that make up the log likelihood and perplexity of a chunk of sessions,
+    so that chunks can be evaluated separately and added up.
+
+    Returns the sum of each session's mean log likelihood, and the sum of the log2
+    probability of the observed click/non-click at each rank.
+    """
+    clicks = clicks & mask
+    conditional, full = click_probabilities(attractiveness, satisfaction, clicks, mask, gamma)
+
+    # Like PyClick, each session's log likelihood is the mean over its results
+    results_per_session = np.maximum(mask.sum(axis=1), 1)
+    log_likelihood = (np.log(conditional).sum(axis=1) / results_per_session).sum()
+
+    observed = np.where(clicks, full, 1 - full)
+    log2_at_rank = np.log2(np.where(mask, observed, 1)).sum(axis=0)
+
+    return log_likelihood, log2_at_rank
+
+
+def _fit_statistics(args):
+    return fit_statistics(*args)
+
+
+def evaluate_fit(model, sessions, processes=None, chunk_size=100000):
+    """
+    Calculate the log likelihood, perplexity, and perplexity at each rank of a trained
+    ClickModel on a set of EncodedSessions.
+
+    If processes is set, the sessions are split into chunks of chunk_size, and
+    evaluated in a pool of worker processes.
+    """
+    attractiveness, satisfaction = model.session_params(sessions)
+    mask = sessions.mask
+
+    chunks = [
+        (attractiveness[start:start + chunk_size], satisfaction[start:start + chunk_size],
+         sessions.clicks[start:start + chunk_size], mask[start:start + chunk_size], model.gamma)
+        for start in range(0, len(sessions), chunk_size)
+    ]
+
+    if processes and len(chunks) > 1:
+        with Pool(processes) as pool:
+            results = pool.map(_fit_statistics, chunks)
+    else:
+        results = [fit_statistics(*chunk) for chunk in chunks]
+
+    n_sessions = max(len(sessions), 1)
+    log_likelihood = sum(result[0] for result in results) / n_sessions
+    log2_at_rank = np.sum([result[1] for result in results], axis=0) if results else np.zeros(RANK_MAX)
+
+    perplexity_at_rank = 2 ** (-log2_at_rank / n_sessions)
+    return FitEvaluation(log_likelihood, perplexity_at_rank.mean(), perplexity_at_rank)
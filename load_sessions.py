@@ -10,123 +10,161 @@ from collections import Counter
 import pandas as pd
 import sys
 import os
-from collections import defaultdict
+import argparse
 import logging
-from database import insert_session_into_database, setup_database, record_dataset
+from database import SessionLoader, setup_database, record_dataset, get_checkpoint
 
 logging.basicConfig(filename='load_sessions.log',level=logging.INFO)
 
 
-def sessions_to_observations(df):
-    """
-    Map from (sessionId, searchTerm) to a list of all indexes relating to that session
-
-    searchTerm is included because a user run multiple searches per session, and we
-    want to consider them separately.
-    """
-    sessions = defaultdict(list)
-    for index, row in df.iterrows():
-        session = row['searchSessionId']
-        search_term = row['searchTerm']
-        sessions[(session, search_term)].append(index)
-
-    return sessions
+SESSION_KEY = ['searchSessionId', 'searchTerm']
 
 
-def session_data(input_data, session_map, session_id):
+def summarise_sessions(df, invalid_counter):
     """
-    Return the clicks and impressions for a single session, highest rank first
-    """
-    indexes = session_map[session_id]
-    rank_order = input_data.loc[indexes].sort_values(by=['rank'], ascending=True)
-    return rank_order
+    Summarise every (sessionId, searchTerm) group in the dataset.
 
+    searchTerm is included because a user run multiple searches per session, and we
+    want to consider them separately.
 
-def process_session(rank_order, invalid_counter):
-    """
-    Look at all clicks and impressions belonging to a session and
-    transform it into a summary of the session.
-    This is really slow.
+    Everything is computed with groupby operations over the whole dataset, rather
+    than slicing out each session individually.
 
     This discards any sessions where we don't have any clicks, or we don't
-    have impressions for the stuff above the final click.
+    have impressions for every rank from 1 to 20.
     """
-    logging.info('session with %d results', len(rank_order))
-    clicks = rank_order[rank_order.observationType == 'click']
+    # A stable sort keeps the original row order for rows with the same rank
+    rank_order = df.sort_values(by=SESSION_KEY + ['rank'], kind='mergesort')
 
-    if not len(clicks):
-        # Discard session if no clicks on first page
-        logging.info('No clicks')
-        invalid_counter['no_clicks'] += 1
-        return None
+    clicks = rank_order[rank_order.observationType == 'click']
+    impressions = rank_order[rank_order.observationType == 'impression']
 
-    final_click_row = clicks.iloc[-1]
+    session_count = len(rank_order.drop_duplicates(SESSION_KEY))
+
+    final_clicks = clicks.drop_duplicates(SESSION_KEY, keep='last').set_index(SESSION_KEY)
+    invalid_counter['no_clicks'] += session_count - len(final_clicks)
+
+    # Sessions are complete if the impressions cover exactly ranks 1-20
+    impression_ranks = impressions.groupby(SESSION_KEY, sort=False)['rank']
+    complete = (
+        (impression_ranks.min() == 1) &
+        (impression_ranks.max() == 20) &
+        (impression_ranks.nunique() == 20)
+    )
+    complete = complete[complete].index
+    valid = final_clicks.index.isin(complete)
+    invalid_counter['missing_impressions'] += len(final_clicks) - int(valid.sum())
+    final_clicks = final_clicks[valid]
+
+    all_results = impressions.groupby(SESSION_KEY, sort=False)['contentIdOrPath'].apply(list)
+    all_results = all_results.reindex(final_clicks.index)
+    clicked_results = clicks.groupby(SESSION_KEY, sort=False)['contentIdOrPath'].apply(list)
+    clicked_results = clicked_results.reindex(final_clicks.index)
+
+    sessions = []
+    for session_id, original_search_term, final_url_clicked, final_rank, all_urls, clicked_urls in zip(
+            final_clicks.index,
+            final_clicks.originalSearchTerm,
+            final_clicks.contentIdOrPath,
+            final_clicks['rank'],
+            all_results,
+            clicked_results):
+
+        sessions.append({
+            'searchSessionId': session_id,
+            'searchTerm': original_search_term,
+            'normalisedSearchTerm': session_id[1],
+            'finalRank': int(final_rank),
+            'allResults': all_urls,
+            'clickedResults': clicked_urls,
+            'finalItemClicked': final_url_clicked,
+        })
+
+    logging.info(f'Summarised {len(sessions)} valid sessions out of {session_count}')
+    return sessions
 
-    search_term = final_click_row['searchTerm']
-    original_search_term = final_click_row['originalSearchTerm']
-    final_url_clicked = final_click_row['contentIdOrPath']
-    final_rank = final_click_row['rank']
 
-    impressions = rank_order[rank_order.observationType == 'impression']
+def read_in_chunks(input_filename, chunksize):
+    """
+    Stream a dataset sorted by searchSessionId, yielding non-empty dataframes that
+    only contain complete sessions.
 
-    all_ranks = set(impressions['rank'].tolist())
-    if all_ranks != set(range(1, 21)):
-        # Discard session if missing impressions
-        logging.info(f'Impression data incomplete for final rank {final_rank}:')
-        logging.info(all_ranks)
-        invalid_counter['missing_impressions'] += 1
+    The last session in each chunk may continue into the next chunk, so its rows
+    are carried over and prepended to the next one.
+    """
+    carried_over = None
+    for chunk in pd.read_csv(input_filename, chunksize=chunksize, dtype={'searchSessionId': str}):
+        if carried_over is not None:
+            chunk = pd.concat([carried_over, chunk])
 
-        return None
+        if not chunk.searchSessionId.is_monotonic_increasing:
+            raise ValueError(f'{input_filename} must be sorted by searchSessionId to read it in chunks')
 
-    all_results = impressions.contentIdOrPath.tolist()
-    clicked_results = clicks.contentIdOrPath.tolist()
+        incomplete = chunk.searchSessionId == chunk.searchSessionId.iloc[-1]
+        carried_over = chunk[incomplete]
 
-    session = {
-        'searchSessionId': session_id,
-        'searchTerm': original_search_term,
-        'normalisedSearchTerm': search_term,
-        'finalRank': final_rank.item(),
-        'allResults': all_results,
-        'clickedResults': clicked_results,
-        'finalItemClicked': final_url_clicked,
-    }
+        # If the whole chunk is one session, there's nothing complete yet
+        if not incomplete.all():
+            yield chunk[~incomplete]
 
-    logging.info(session)
-    return session
+    if carried_over is not None and not carried_over.empty:
+        yield carried_over
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('Usage: python load_sessions.py [input csv]')
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Summarise sessions and load them into the database')
+    parser.add_argument('input_filename')
+    parser.add_argument('--chunksize', type=int, help='Stream the input this many rows at a time instead of loading it all into memory')
+    parser.add_argument('--resume', action='store_true', help='Carry on loading a file that was interrupted, after the last batch that was committed')
+    args = parser.parse_args()
 
-    input_filename = sys.argv[1]
+    input_filename = args.input_filename
 
     print('Setting up database...')
     conn = setup_database()
 
     print('Loading input...')
-    df = pd.read_csv(input_filename)
+    if args.chunksize:
+        chunks = read_in_chunks(input_filename, args.chunksize)
+    else:
+        chunks = [pd.read_csv(input_filename, dtype={'searchSessionId': str})]
+
+    checkpoint = get_checkpoint(conn, input_filename)
+    resume_after = None
+
+    if checkpoint is None:
+        dataset_id = record_dataset(conn, input_filename)
+    elif not args.resume:
+        print(f'{input_filename} has already been loaded. Use --resume to carry on an interrupted load.')
+        sys.exit(1)
+    else:
+        dataset_id, resume_after, complete = checkpoint
+        if complete:
+            print(f'{input_filename} has already been completely loaded')
+            sys.exit(0)
+        print(f'Resuming dataset {dataset_id} after session {resume_after}')
+
+    loader = SessionLoader(conn, dataset_id=dataset_id, resume_after=resume_after)
+    invalid_counter = Counter()
+    inserted = 0
 
-    print('Creating session map...')
-    session_map = sessions_to_observations(df)
+    # Chunks are sorted by session, so skip any that were committed already without summarising them
+    resume_point = loader.resume_point()
 
-    print('Processing sessions...')
-    dataset_id = record_dataset(conn, input_filename)
+    for df in chunks:
+        if resume_point and args.chunksize and not df.empty and df.searchSessionId.iloc[-1] < resume_point[0]:
+            continue
 
-    invalid_counter = Counter()
-    for session_id in session_map:
-        logging.info(session_id)
-        session_df = session_data(df, session_map, session_id)
-        session_summary = process_session(session_df, invalid_counter=invalid_counter)
+        print(f'Summarising {len(df)} rows...')
+        sessions = summarise_sessions(df, invalid_counter=invalid_counter)
 
-        if session_summary is None:
-            continue
+        print(f'Loading {len(sessions)} sessions...')
+        inserted += loader.load(sessions, invalid_counter=invalid_counter)
 
-        try:
-            insert_session_into_database(session_summary, conn, dataset_id=dataset_id)
-        except Exception:
-            logging.exception('Unable to insert into database: {session_summary}')
-            invalid_counter['database_errors'] += 1
+    print(f'Inserted {inserted} sessions')
+    print(f'Invalid sessions: {invalid_counter}')
 
-    print(f'Invalid sessions: {invalid_counter}')
\ No newline at end of file
+    # Leave the dataset incomplete if anything failed, so that --resume retries it
+    if invalid_counter['database_errors'] or not loader.finish():
+        print('Some sessions could not be inserted, see load_sessions.log. Rerun with --resume to retry them.')
+        sys.exit(1)
@@ -0,0 +1,178 @@
+"""
+A local stand-in for the google analytics data in bigquery, so the whole pipeline
+can be run (and benchmarked) offline.
+
+Fixtures are stored in a SQLite database, with one row per session in the same nested
+structure as the ga_sessions_* tables. The repeated fields (hits, products and custom
+dimensions) are stored as JSON, and unnested with json_each in the same way the bigquery
+query uses UNNEST. The date column plays the part of _TABLE_SUFFIX.
+
+To create some fixtures:
+python local_bigquery.py data/ga_fixtures.db 2018-04-01 2018-04-07 --sessions 1000
+
+Then run the pipeline with --fixtures data/ga_fixtures.db
+"""
+import argparse
+import json
+import sqlite3
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+# The same as bigquery.QUERY_TEMPLATE, but for the SQLite fixtures
+QUERY_TEMPLATE = '''
+SELECT
+fullVisitorId || '|' || CAST(visitId AS TEXT) AS sessionId,
+json_extract(customDimensions.value, '$.value') AS searchTerm,
+json_extract(hits.value, '$.hitNumber') AS hitNumber,
+json_extract(product.value, '$.productSKU') AS contentIdOrPath,
+json_extract(product.value, '$.productListPosition') AS linkPosition,
+CASE
+    WHEN json_extract(product.value, '$.isImpression') = 1 AND json_extract(product.value, '$.isClick') IS NULL THEN 'impression'
+    WHEN json_extract(product.value, '$.isClick') = 1 AND json_extract(product.value, '$.isImpression') IS NULL THEN 'click'
+    ELSE NULL
+END AS observationType
+
+FROM ga_sessions
+CROSS JOIN json_each(ga_sessions.hits) AS hits
+CROSS JOIN json_each(hits.value, '$.product') AS product
+CROSS JOIN json_each(product.value, '$.customDimensions') AS customDimensions
+
+WHERE json_extract(product.value, '$.productListName') = 'Site search results'
+AND ga_sessions.date BETWEEN '{start_date:%Y%m%d}' AND '{end_date:%Y%m%d}'
+AND json_extract(product.value, '$.productListPosition') <= 20
+AND json_extract(customDimensions.value, '$.index') = 71
+
+-- Keep all rows for a session together, so the output can be processed in chunks
+ORDER BY sessionId
+'''
+
+SEARCH_TERMS = [
+    'tax', 'passport', 'universal credit', 'driving licence', 'visa',
+    'child benefit', 'pension', 'self assessment', 'mot', 'council tax',
+]
+
+DOCUMENTS_PER_TERM = 40
+
+
+class LocalSource:
+    """
+    Runs queries against a SQLite database of fixtures
+    """
+    query_template = QUERY_TEMPLATE
+
+    def __init__(self, path):
+        self.path = path
+        self.name = f'local:{path}'
+
+    def read(self, query):
+        conn = sqlite3.connect(self.path)
+        try:
+            return pd.read_sql_query(query, conn)
+        finally:
+            conn.close()
+
+
+def fake_session(rng, visit_id, day):
+    """
+    Make up a session containing a few searches, in the nested GA format.
+
+    Each search shows 20 results for a search term, and the user clicks on some of them.
+    Results further down the page are less likely to be clicked, and each result has a
+    fixed attractiveness for the search term, so click models have something to find.
+    """
+    hits = []
+    hit_number = 1
+
+    for _ in range(rng.randint(1, 3)):
+        term_id = rng.randint(len(SEARCH_TERMS))
+        search_term = SEARCH_TERMS[term_id]
+        documents = rng.choice(DOCUMENTS_PER_TERM, 20, replace=False)
+
+        impressions = [
+            {
+                'productSKU': f'/{search_term.replace(" ", "-")}/{document}',
+                'productListName': 'Site search results',
+                'productListPosition': rank,
+                'isImpression': True,
+                'customDimensions': [{'index': 71, 'value': search_term}],
+            }
+            for rank, document in enumerate(documents, start=1)
+        ]
+
+        # Occasionally a results page is missing an impression
+        if rng.rand() < 0.05:
+            del impressions[rng.randint(20)]
+
+        hits.append({'hitNumber': hit_number, 'type': 'PAGE', 'product': impressions})
+        hit_number += 1
+
+        # Related links aren't search results, so the query should ignore them
+        hits.append({'hitNumber': hit_number, 'type': 'PAGE', 'product': [{
+            'productSKU': '/related',
+            'productListName': 'Related content',
+            'productListPosition': 1,
+            'isImpression': True,
+            'customDimensions': [{'index': 71, 'value': search_term}],
+        }]})
+        hit_number += 1
+
+        attractiveness = ((documents * 7919 + term_id) % DOCUMENTS_PER_TERM) / DOCUMENTS_PER_TERM
+        examination = 0.9 ** np.arange(20)
+        for rank in np.flatnonzero(rng.rand(20) < attractiveness * examination * 0.5):
+            click = dict(impressions[0], productSKU=f'/{search_term.replace(" ", "-")}/{documents[rank]}', productListPosition=int(rank) + 1)
+            del click['isImpression']
+            click['isClick'] = True
+            hits.append({'hitNumber': hit_number, 'type': 'PAGE', 'product': [click]})
+            hit_number += 1
+
+    return {
+        'date': f'{day:%Y%m%d}',
+        'fullVisitorId': str(rng.randint(10 ** 9)),
+        'visitId': visit_id,
+        'hits': json.dumps(hits),
+    }
+
+
+def create_fixtures(path, start_date, end_date, sessions_per_day=1000, seed=0):
+    """
+    Create a database of made up sessions for every day from start_date to end_date (inclusive)
+    """
+    rng = np.random.RandomState(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('create table if not exists ga_sessions (date text, fullVisitorId text, visitId integer, hits text)')
+    conn.execute('create index if not exists ga_sessions_date on ga_sessions (date)')
+
+    visit_id = 0
+    day = start_date
+    while day <= end_date:
+        sessions = []
+        for _ in range(sessions_per_day):
+            visit_id += 1
+            sessions.append(fake_session(rng, visit_id, day))
+
+        conn.executemany(
+            'insert into ga_sessions (date, fullVisitorId, visitId, hits) values (:date, :fullVisitorId, :visitId, :hits)',
+            sessions
+        )
+        day += timedelta(days=1)
+
+    conn.commit()
+    conn.close()
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create fixtures for running the pipeline offline')
+    parser.add_argument('path', help='The SQLite database to create')
+    parser.add_argument('start_date', type=parse_date, help='First day, as YYYY-MM-DD')
+    parser.add_argument('end_date', type=parse_date, help='Last day, as YYYY-MM-DD')
+    parser.add_argument('--sessions', type=int, default=1000, help='Number of sessions per day')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    create_fixtures(args.path, args.start_date, args.end_date, sessions_per_day=args.sessions, seed=args.seed)
+    print(f'Created fixtures in {args.path}')
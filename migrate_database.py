@@ -0,0 +1,171 @@
+"""
+Migrate an existing database to the current schema in database.py.
+
+This:
+- adds session counts to the queries table
+- dictionary encodes the URLs in the searches table, so they are stored as arrays of
+  integer IDs from the results table, rather than repeating every URL in every row
+- optionally partitions the searches table by dataset, so each dataset can be
+  read (or dropped) without touching the others
+- adds indexes on searches.query_id and searches.dataset_id
+- stores the documents in sdbn_counts as result IDs instead of URLs
+
+This only works with Postgres. A SQLite database can just be recreated.
+Rewriting the searches table can take a while, so back up the database first.
+Each step checks whether it's needed, so it's safe to run this more than once.
+
+Usage: python migrate_database.py [--partition]
+"""
+import argparse
+import time
+import sqlalchemy
+from sqlalchemy.sql import select
+from database import engine, metadata, search_table, result_table, dataset_table, is_partitioned, create_search_partition, refresh_query_session_counts
+
+# Copy searches that still have URL arrays, looking up each URL in the results table
+ENCODE_SEARCHES = '''
+select
+    s.id,
+    s.query_id,
+    s.dataset_id,
+    array(
+        select r.result_id from unnest(s.clicked_urls) with ordinality as u(url, position)
+        join results r on r.url = u.url order by u.position
+    ),
+    array(
+        select r.result_id from unnest(s.all_urls) with ordinality as u(url, position)
+        join results r on r.url = u.url order by u.position
+    ),
+    (select r.result_id from results r where r.url = s.final_click_url),
+    s.final_click_rank
+from searches s
+'''
+
+# Copy searches that have already been encoded
+COPY_SEARCHES = '''
+select id, query_id, dataset_id, clicked_result_ids, all_result_ids, final_click_result_id, final_click_rank
+from searches
+'''
+
+
+def get_column_names(conn, table_name):
+    return {column['name'] for column in sqlalchemy.inspect(conn).get_columns(table_name)}
+
+
+def add_session_counts(conn):
+    print('Adding session counts to queries...')
+    conn.execute('alter table queries add column session_count bigint not null default 0')
+    refresh_query_session_counts(conn)
+
+
+def encode_result_urls(conn):
+    """
+    Add every URL in the searches table to the results table
+    """
+    print('Creating results table...')
+    result_table.create(conn, checkfirst=True)
+    conn.execute('''
+        insert into results (url)
+        select url from (
+            select unnest(all_urls) as url from searches
+            union select unnest(clicked_urls) from searches
+            union select final_click_url from searches
+        ) urls
+        order by url
+        on conflict (url) do nothing
+    ''')
+
+
+def rebuild_searches(conn, source, partition):
+    """
+    Copy the searches table into a new table with the current schema and swap them over
+    """
+    primary_key = 'id, dataset_id' if partition else 'id'
+    partition_by = 'partition by list (dataset_id)' if partition else ''
+
+    conn.execute(f'''
+        create table searches_new (
+            id bigint not null default nextval('searches_id_seq'),
+            query_id bigint references queries (query_id) on delete cascade,
+            dataset_id bigint references datasets (dataset_id) on delete cascade,
+            clicked_result_ids integer[] not null,
+            all_result_ids integer[] not null,
+            final_click_result_id integer not null references results (result_id),
+            final_click_rank integer not null,
+            primary key ({primary_key})
+        ) {partition_by}
+    ''')
+
+    if partition:
+        dataset_ids = [row[0] for row in conn.execute(select([dataset_table.c.dataset_id]))]
+        print(f'Creating {len(dataset_ids)} partitions...')
+        for dataset_id in dataset_ids:
+            create_search_partition(conn, dataset_id, table_name='searches_new')
+
+        # Catches any searches that don't belong to a dataset
+        conn.execute('create table searches_default partition of searches_new default')
+
+    print('Copying searches...')
+    start = time.time()
+    result = conn.execute(f'''
+        insert into searches_new (id, query_id, dataset_id, clicked_result_ids, all_result_ids, final_click_result_id, final_click_rank)
+        {source}
+    ''')
+    print(f'Copied {result.rowcount} searches in {time.time() - start:.0f}s')
+
+    conn.execute('alter sequence searches_id_seq owned by searches_new.id')
+    conn.execute('drop table searches')
+    conn.execute('alter table searches_new rename to searches')
+    conn.execute('alter index searches_new_pkey rename to searches_pkey')
+
+
+def encode_sdbn_count_documents(conn):
+    """
+    Replace the URLs in the sdbn_counts table with IDs from the results table.
+    The counts only come from searches, so every URL should already be in there.
+    """
+    print('Encoding documents in sdbn_counts...')
+    conn.execute('alter table sdbn_counts add column result_id integer references results (result_id)')
+    conn.execute('update sdbn_counts c set result_id = r.result_id from results r where r.url = c.document')
+    conn.execute('alter table sdbn_counts alter column result_id set not null')
+    conn.execute('alter table sdbn_counts drop constraint sdbn_counts_pkey')
+    conn.execute('alter table sdbn_counts drop column document')
+    conn.execute('alter table sdbn_counts add primary key (dataset_id, query_id, result_id)')
+
+
+def add_indexes(conn):
+    print('Adding indexes...')
+    for column in ('query_id', 'dataset_id'):
+        conn.execute(f'create index if not exists ix_searches_{column} on searches ({column})')
+
+
+def migrate(conn, partition=False):
+    if 'session_count' not in get_column_names(conn, 'queries'):
+        add_session_counts(conn)
+
+    with conn.begin():
+        if 'all_urls' in get_column_names(conn, 'searches'):
+            encode_result_urls(conn)
+            rebuild_searches(conn, ENCODE_SEARCHES, partition)
+        elif partition and not is_partitioned(conn, search_table):
+            rebuild_searches(conn, COPY_SEARCHES, partition)
+
+        add_indexes(conn)
+
+        if 'document' in get_column_names(conn, 'sdbn_counts'):
+            encode_sdbn_count_documents(conn)
+
+    conn.execute('analyze searches')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the database to the current schema')
+    parser.add_argument('--partition', action='store_true', help='Partition the searches table by dataset')
+    args = parser.parse_args()
+
+    # Create any tables that don't exist yet
+    metadata.create_all(engine)
+
+    conn = engine.connect()
+    migrate(conn, partition=args.partition)
+    print('Done')
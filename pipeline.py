@@ -0,0 +1,132 @@
+"""
+Run the whole ETL pipeline for a range of days.
+
+Each day is a separate partition: it's exported from bigquery to its own file,
+cleaned, summarised into sessions, and then loaded into the database as its own dataset.
+Days that have already been loaded are skipped, and days that were partly loaded
+are resumed, so you can rerun the pipeline over the same range to fill in any gaps.
+
+Exporting, cleaning and summarising run in a pool of worker processes, one day per
+process. Each day is loaded by the main process as soon as it's ready, with one bulk load per day.
+
+Usage: python pipeline.py START_DATE END_DATE
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from multiprocessing import Pool, cpu_count
+import pandas as pd
+from bigquery import export_search_sessions
+from local_bigquery import LocalSource
+from clean_data_from_bigquery import clean
+from load_sessions import summarise_sessions
+from database import SessionLoader, setup_database, record_dataset, get_dataset_filenames, get_checkpoint
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def days_between(start_date, end_date):
+    """
+    Get every day from start_date to end_date (inclusive)
+    """
+    return [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+
+
+def export_filename(data_dir, day):
+    return os.path.join(data_dir, f'bigquery_results_{day:%Y%m%d}.csv')
+
+
+def prepare_partition(data_dir, day, source=None):
+    """
+    Export, clean and summarise the sessions for one day.
+    Returns (filename, sessions, invalid_counter)
+    """
+    filename = export_filename(data_dir, day)
+    if not os.path.exists(filename):
+        export_search_sessions(day, day, filename, source=source)
+
+    # There are a handful of searches for literally "null"
+    # Don't try and interpret that
+    df = clean(pd.read_csv(filename, na_filter=False, dtype={'sessionId': str}))
+
+    invalid_counter = Counter()
+    sessions = summarise_sessions(df, invalid_counter=invalid_counter)
+    return filename, sessions, invalid_counter
+
+
+def _prepare_partition(args):
+    """
+    Prepare a partition in a worker process. If anything goes wrong, log it and
+    return None instead of the sessions, so the other days can still be loaded.
+    """
+    data_dir, day, source = args
+    try:
+        return prepare_partition(data_dir, day, source=source)
+    except Exception:
+        logging.exception(f'Unable to prepare sessions for {day}')
+        return export_filename(data_dir, day), None, None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export, clean and load search sessions for a range of days')
+    parser.add_argument('start_date', type=parse_date, help='First day to load, as YYYY-MM-DD')
+    parser.add_argument('end_date', type=parse_date, help='Last day to load, as YYYY-MM-DD')
+    parser.add_argument('--data-dir', default='data/pipeline', help='Where to save the exported data')
+    parser.add_argument('--processes', type=int, default=cpu_count(), help='Number of days to process at once')
+    parser.add_argument('--fixtures', help='Export from a local fixtures database (see local_bigquery.py) instead of bigquery')
+    args = parser.parse_args()
+
+    source = LocalSource(args.fixtures) if args.fixtures else None
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    conn = setup_database()
+
+    loaded = get_dataset_filenames(conn)
+    days = [day for day in days_between(args.start_date, args.end_date) if export_filename(args.data_dir, day) not in loaded]
+    print(f'{len(days)} days to load, skipping {len(days_between(args.start_date, args.end_date)) - len(days)} already loaded')
+
+    total_counter = Counter()
+    total_inserted = 0
+    failed = []
+    start = time.time()
+
+    with Pool(args.processes) as pool:
+        partitions = pool.imap_unordered(_prepare_partition, [(args.data_dir, day, source) for day in days])
+
+        for filename, sessions, invalid_counter in partitions:
+            if sessions is None:
+                print(f'Failed to prepare {filename}, see load_sessions.log')
+                failed.append(filename)
+                continue
+
+            # Carry on from where we got to if a previous run was interrupted
+            checkpoint = get_checkpoint(conn, filename)
+            if checkpoint is None:
+                dataset_id, resume_after = record_dataset(conn, filename), None
+            else:
+                dataset_id, resume_after, _ = checkpoint
+
+            loader = SessionLoader(conn, dataset_id=dataset_id, resume_after=resume_after)
+            inserted = loader.load(sessions, invalid_counter=invalid_counter)
+
+            # Days with sessions that couldn't be inserted are left incomplete, so rerunning retries them
+            if invalid_counter['database_errors'] or not loader.finish():
+                print(f'Failed to insert some sessions from {filename}, see load_sessions.log')
+                failed.append(filename)
+            print(f'Loaded {inserted} sessions from {filename} as dataset {dataset_id} ({time.time() - start:.0f}s)')
+
+            total_inserted += inserted
+            total_counter.update(invalid_counter)
+
+    print(f'Inserted {total_inserted} sessions')
+    print(f'Invalid sessions: {total_counter}')
+
+    if failed:
+        print(f'{len(failed)} days failed and were not completely loaded, rerun the pipeline to retry them: {sorted(failed)}')
+        sys.exit(1)
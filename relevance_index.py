@@ -0,0 +1,138 @@
+"""
+A precomputed index of the relevance of every document for every query.
+
+This is built once from a trained model, and stores (query, document, relevance,
+examinations, rank) for every document that has been examined enough times,
+sorted by query and then by rank. Looking up the ranking for a query is then just
+a slice of some arrays, without touching the model at all.
+
+The index is saved as numpy arrays, so it can be memory mapped.
+"""
+import sys
+import numpy as np
+import pandas as pd
+from storage import save_arrays, load_arrays
+
+FORMAT_VERSION = 1
+
+
+class RelevanceIndex:
+    @staticmethod
+    def build(model):
+        """
+        Build an index from a model with a relevance_table method
+        """
+        return RelevanceIndex.from_table(model.relevance_table())
+
+    @staticmethod
+    def from_table(table):
+        """
+        Build an index from a dataframe indexed by (query, document),
+        with columns for relevance and examinations
+        """
+        table = table.reset_index()
+        query_ids, queries = pd.factorize(table['query'])
+        document_ids, documents = pd.factorize(table['document'])
+        ranks = table.groupby('query')['relevance'].rank(method='min', ascending=False).values
+
+        order = np.lexsort((ranks, query_ids))
+        query_offsets = np.r_[0, np.cumsum(np.bincount(query_ids, minlength=len(queries)))]
+
+        arrays = {
+            'query_offsets': query_offsets.astype(np.int64),
+            'document_ids': document_ids[order].astype(np.int32),
+            'relevance': table.relevance.values[order].astype(np.float32),
+            'examinations': table.examinations.values[order].astype(np.int32),
+            'ranks': ranks[order].astype(np.int32),
+        }
+
+        return RelevanceIndex(pd.Index(queries), pd.Index(documents), arrays)
+
+    @staticmethod
+    def load(directory, mmap_mode='r'):
+        arrays, strings, metadata = load_arrays(directory, mmap_mode=mmap_mode)
+        if metadata.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f'{directory} is not a version {FORMAT_VERSION} relevance index')
+
+        return RelevanceIndex(pd.Index(strings['queries']), pd.Index(strings['documents']), arrays)
+
+    def __init__(self, queries, documents, arrays):
+        self.queries = queries
+        self.documents = documents
+        self.arrays = arrays
+        self.query_ids = {query: query_id for query_id, query in enumerate(queries)}
+
+    def save(self, directory):
+        save_arrays(
+            directory,
+            self.arrays,
+            strings={'queries': self.queries, 'documents': self.documents},
+            metadata={'format_version': FORMAT_VERSION}
+        )
+
+    def query_slice(self, query):
+        """
+        Get the range of array positions for a query's documents
+        """
+        try:
+            query_id = self.query_ids[query]
+        except KeyError:
+            return slice(0, 0)
+
+        offsets = self.arrays['query_offsets']
+        return slice(offsets[query_id], offsets[query_id + 1])
+
+    def relevance(self, query):
+        """
+        Get the relevance of every document for a query, most relevant first
+        """
+        positions = self.query_slice(query)
+        return pd.Series(
+            np.asarray(self.arrays['relevance'][positions], dtype=float),
+            index=self.documents[self.arrays['document_ids'][positions]]
+        )
+
+    def ranking(self, query):
+        """
+        Get the new rank of every document for a query
+        """
+        positions = self.query_slice(query)
+        return pd.Series(
+            np.asarray(self.arrays['ranks'][positions]),
+            index=self.documents[self.arrays['document_ids'][positions]]
+        )
+
+    def rankings(self, queries):
+        """
+        Get the new rank of every document for several queries.
+        Returns a series of new ranks indexed by (query, document)
+        """
+        offsets = self.arrays['query_offsets']
+        query_ids = np.array([self.query_ids.get(query, -1) for query in queries], dtype=np.int64)
+        query_ids = query_ids[query_ids >= 0]
+
+        starts = offsets[query_ids]
+        lengths = offsets[query_ids + 1] - starts
+
+        # Positions of every document for the queries, in order
+        positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+        index = pd.MultiIndex.from_arrays(
+            [
+                np.asarray(self.queries, dtype=object)[np.repeat(query_ids, lengths)],
+                np.asarray(self.documents, dtype=object)[self.arrays['document_ids'][positions]],
+            ],
+            names=['query', 'document']
+        )
+        return pd.Series(np.asarray(self.arrays['ranks'][positions]), index=index)
+
+
+if __name__ == '__main__':
+    from estimate_relevance import ClickModel
+
+    if len(sys.argv) < 3:
+        print('Usage: python relevance_index.py [model directory] [output directory]')
+        sys.exit(1)
+
+    model = ClickModel.load(sys.argv[1])
+    RelevanceIndex.build(model).save(sys.argv[2])
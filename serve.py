@@ -0,0 +1,255 @@
+"""
+Serve reranked search results from a relevance index.
+
+The index (see relevance_index.py) is loaded into memory at startup. Each request sends
+a query and the list of results the search engine returned, and gets back the same
+results reordered by the click model: results the model has a rank for come first, in
+the model's order, followed by the rest in their original order.
+
+Queries are looked up as they are, and if that doesn't match, by their normalised
+form (the same normalise_search_terms used when cleaning the data).
+
+A background thread checks the index directory for a newly saved model, and swaps it in
+once it has loaded. Requests that are already running finish with the old model, so
+nothing is dropped.
+
+Usage: python serve.py data/sdbn_relevance_index --port 8000
+
+curl -d '{"query": "tax", "results": ["/a", "/b"]}' http://localhost:8000/rerank
+curl http://localhost:8000/metrics
+"""
+import argparse
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import numpy as np
+from relevance_index import RelevanceIndex
+from storage import METADATA_FILE
+from clean_data_from_bigquery import normalise_search_terms
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1, float('inf')]
+
+QUERY_CACHE_SIZE = 100000
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def normalise_query(query):
+    return normalise_search_terms(query.strip().lower())
+
+
+class LatencyHistogram:
+    """
+    Counts of request latencies, in the Prometheus text format
+    """
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.total += seconds
+
+    def to_text(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+
+        lines = [f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bucket, count in zip(self.buckets, counts):
+            cumulative += count
+            le = '+Inf' if bucket == float('inf') else repr(bucket)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {total}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+class Reranker:
+    """
+    A relevance index held in memory, with lookups for reranking results
+    """
+    @staticmethod
+    def load(directory, cache_size=QUERY_CACHE_SIZE):
+        version = os.stat(os.path.join(directory, METADATA_FILE)).st_mtime
+        return Reranker(RelevanceIndex.load(directory, mmap_mode=None), version, cache_size)
+
+    def __init__(self, index, version=None, cache_size=QUERY_CACHE_SIZE):
+        self.index = index
+        self.version = version
+        self.document_names = np.asarray(index.documents, dtype=object)
+        self.query_ranks = lru_cache(maxsize=cache_size)(self._query_ranks)
+
+        # Several queries can normalise to the same thing, so use the most examined one
+        query_sizes = np.diff(index.arrays['query_offsets'])
+        examinations = np.bincount(
+            np.repeat(np.arange(len(query_sizes)), query_sizes),
+            weights=index.arrays['examinations'],
+            minlength=len(query_sizes)
+        )
+        self.aliases = {}
+        for query in np.asarray(index.queries, dtype=object)[np.argsort(examinations, kind='mergesort')]:
+            self.aliases[normalise_query(query)] = query
+
+    def _query_ranks(self, query):
+        """
+        Get a dictionary of the new rank of each document for a query
+        """
+        positions = self.index.query_slice(query)
+        documents = self.document_names[self.index.arrays['document_ids'][positions]]
+        return dict(zip(documents, self.index.arrays['ranks'][positions].tolist()))
+
+    def resolve(self, query):
+        """
+        Find the query in the index, or None if there isn't one
+        """
+        if query in self.index.query_ids:
+            return query
+        return self.aliases.get(normalise_query(query))
+
+    def rerank(self, query, results):
+        """
+        Reorder a list of results for a query.
+        Returns (the reordered results, the query that was used, or None)
+        """
+        matched_query = self.resolve(query)
+        if matched_query is None:
+            return list(results), None
+
+        ranks = self.query_ranks(matched_query)
+        unranked = len(ranks) + 1
+        order = sorted(range(len(results)), key=lambda i: (ranks.get(results[i], unranked), i))
+        return [results[i] for i in order], matched_query
+
+
+class ModelWatcher(threading.Thread):
+    """
+    Checks whether the index has been saved again, and if so, loads it and swaps it in.
+
+    save_arrays atomically replaces the metadata file once a new index is complete, so a
+    change to it means there's a new index to load, and loading never mixes files from
+    two saves. If it can't be loaded anyway, it's tried again on the next check.
+    """
+    def __init__(self, server, directory, interval=5, cache_size=QUERY_CACHE_SIZE):
+        super().__init__(daemon=True)
+        self.server = server
+        self.directory = directory
+        self.interval = interval
+        self.cache_size = cache_size
+
+    def check(self):
+        try:
+            version = os.stat(os.path.join(self.directory, METADATA_FILE)).st_mtime
+            if version == self.server.reranker.version:
+                return False
+
+            start = time.time()
+            self.server.reranker = Reranker.load(self.directory, self.cache_size)
+            logging.info(f'Loaded new index from {self.directory} in {time.time() - start:.2f}s')
+            return True
+        except Exception:
+            logging.exception(f'Unable to load new index from {self.directory}')
+            return False
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+
+class RerankHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, status, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        try:
+            self.handle_rerank()
+        finally:
+            self.server.latency.observe(time.perf_counter() - start)
+
+    def handle_rerank(self):
+        if self.path != '/rerank':
+            self.send_body(404, json.dumps({'error': 'not found'}))
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            query = request['query']
+            results = request['results']
+        except (ValueError, KeyError, TypeError):
+            query = results = None
+
+        if not isinstance(query, str) or not isinstance(results, list) or not all(isinstance(result, str) for result in results):
+            self.send_body(400, json.dumps({'error': 'expected {"query": "...", "results": ["...", ...]}'}))
+            return
+
+        # Hold on to this model for the whole request, even if a new one is swapped in
+        reranker = self.server.reranker
+        try:
+            reranked, matched_query = reranker.rerank(query, results)
+        except Exception:
+            logging.exception(f'Unable to rerank {query!r}')
+            self.send_body(500, json.dumps({'error': 'unable to rerank'}))
+            return
+
+        self.send_body(200, json.dumps({'query': matched_query, 'results': reranked, 'model_version': reranker.version}))
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_body(200, self.server.latency.to_text(), content_type='text/plain; version=0.0.4')
+        elif self.path == '/health':
+            reranker = self.server.reranker
+            self.send_body(200, json.dumps({'model_version': reranker.version, 'queries': len(reranker.index.queries)}))
+        else:
+            self.send_body(404, json.dumps({'error': 'not found'}))
+
+    def log_message(self, format, *args):
+        # Logging every request would take longer than reranking it
+        pass
+
+
+class RerankServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, reranker):
+        super().__init__(address, RerankHandler)
+        self.reranker = reranker
+        self.latency = LatencyHistogram('rerank_request_duration_seconds')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='serve.log', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Serve reranked search results from a relevance index')
+    parser.add_argument('index_dir', help='A relevance index saved by relevance_index.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--poll-interval', type=float, default=5, help='How often to check for a new index, in seconds')
+    parser.add_argument('--cache-size', type=int, default=QUERY_CACHE_SIZE, help='Number of queries to keep rankings for')
+    args = parser.parse_args()
+
+    server = RerankServer((args.host, args.port), Reranker.load(args.index_dir, args.cache_size))
+    ModelWatcher(server, args.index_dir, interval=args.poll_interval, cache_size=args.cache_size).start()
+
+    print(f'Serving {args.index_dir} on http://{args.host}:{args.port}')
+    server.serve_forever()
@@ -0,0 +1,133 @@
+"""
+A compact binary format for the training and test datasets.
+
+Queries and URLs are dictionary encoded, and every session is stored as:
+- a row of a (sessions x 20) matrix of the results the user saw (see encoded_sessions.py)
+- a bitmask of which of those results were clicked
+- the complete all_urls and clicked_urls lists, in a ragged format (one array of
+  URL IDs, and an array of offsets where each session's list starts)
+
+This is much smaller and faster to load than CSVs of python lists, and the
+arrays can be memory mapped by several processes at once.
+"""
+import numpy as np
+import pandas as pd
+from encoded_sessions import EncodedSessions, RANK_MAX, encode_sessions
+from storage import save_arrays, load_arrays
+
+FORMAT_VERSION = 1
+
+
+def encode_lists(lists, documents):
+    """
+    Encode a sequence of lists of URLs as (offsets, values)
+    """
+    lengths = np.fromiter((len(urls) for urls in lists), dtype=np.int64, count=len(lists))
+    offsets = np.r_[0, np.cumsum(lengths)]
+    flat = [url for urls in lists for url in urls]
+    return offsets, documents.get_indexer(flat).astype(np.int32)
+
+
+def decode_lists(offsets, values, documents):
+    """
+    Decode (offsets, values) into a list of lists of URLs
+    """
+    urls = np.asarray(documents, dtype=object)[values]
+    return [list(session_urls) for session_urls in np.split(urls, offsets[1:-1])]
+
+
+class SessionStore:
+    """
+    A set of searches, as returned by get_searches, stored as numpy arrays
+    """
+    @staticmethod
+    def from_frame(searches):
+        encoded = encode_sessions(searches)
+
+        # Clicked URLs should always have been displayed, but add any that weren't
+        # to the dictionary, so we can reproduce the original data exactly
+        other_urls = pd.Index(
+            [url for urls in searches.clicked_urls for url in urls] +
+            list(searches.final_click_url) +
+            [url for urls in searches.all_urls for url in urls]
+        ).unique()
+        documents = encoded.documents.append(other_urls[~other_urls.isin(encoded.documents)])
+
+        all_urls_offsets, all_urls = encode_lists(searches.all_urls.tolist(), documents)
+        clicked_urls_offsets, clicked_urls = encode_lists(searches.clicked_urls.tolist(), documents)
+
+        # One bit per rank (20 bits per session)
+        click_bits = (encoded.clicks.astype(np.uint32) << np.arange(RANK_MAX, dtype=np.uint32)).sum(axis=1, dtype=np.uint32)
+
+        arrays = {
+            'ids': np.asarray(searches.index, dtype=np.int64),
+            'query_ids': encoded.query_ids,
+            'results': encoded.results,
+            'click_bits': click_bits,
+            'final_click_urls': documents.get_indexer(searches.final_click_url).astype(np.int32),
+            'final_click_ranks': np.asarray(searches.final_click_rank, dtype=np.int32),
+            'all_urls_offsets': all_urls_offsets,
+            'all_urls': all_urls,
+            'clicked_urls_offsets': clicked_urls_offsets,
+            'clicked_urls': clicked_urls,
+        }
+
+        return SessionStore(encoded.queries, documents, arrays)
+
+    @staticmethod
+    def load(directory, mmap_mode='r'):
+        arrays, strings, metadata = load_arrays(directory, mmap_mode=mmap_mode)
+        if metadata.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f'{directory} is not a version {FORMAT_VERSION} session store')
+
+        return SessionStore(pd.Index(strings['queries']), pd.Index(strings['documents']), arrays)
+
+    def __init__(self, queries, documents, arrays):
+        self.queries = queries
+        self.documents = documents
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays['ids'])
+
+    def save(self, directory):
+        save_arrays(
+            directory,
+            self.arrays,
+            strings={'queries': self.queries, 'documents': self.documents},
+            metadata={'format_version': FORMAT_VERSION}
+        )
+
+    def encoded(self):
+        """
+        Get the sessions in the format used to train click models.
+        This uses the stored arrays directly, apart from the clicks.
+        """
+        click_bits = self.arrays['click_bits'][:, np.newaxis]
+        clicks = (click_bits >> np.arange(RANK_MAX, dtype=np.uint32)) & 1 == 1
+
+        return EncodedSessions(
+            queries=self.queries,
+            documents=self.documents,
+            query_ids=self.arrays['query_ids'],
+            results=self.arrays['results'],
+            clicks=clicks
+        )
+
+    def to_frame(self):
+        """
+        Get the same dataframe we stored
+        """
+        arrays = self.arrays
+        df = pd.DataFrame(
+            {
+                'final_click_url': np.asarray(self.documents, dtype=object)[arrays['final_click_urls']],
+                'final_click_rank': np.asarray(arrays['final_click_ranks']),
+                'search_term_lowercase': np.asarray(self.queries, dtype=object)[arrays['query_ids']],
+                'all_urls': decode_lists(arrays['all_urls_offsets'], arrays['all_urls'], self.documents),
+                'clicked_urls': decode_lists(arrays['clicked_urls_offsets'], arrays['clicked_urls'], self.documents),
+            },
+            index=pd.Index(np.asarray(arrays['ids']), name='id'),
+            columns=['final_click_url', 'final_click_rank', 'search_term_lowercase', 'all_urls', 'clicked_urls']
+        )
+        return df
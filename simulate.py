@@ -0,0 +1,192 @@
+"""
+Simulate search sessions from a known click model.
+
+This produces data shaped like ours (20 results per page, a few very popular queries
+and a long tail of less popular ones, reloaded result pages), but where we know the
+true attractiveness and satisfaction of every result, so we can check that the
+trained models recover them. It's also used by benchmark.py to generate data at
+different scales.
+
+Clicks are simulated from a DBN: the user examines the results from the top, clicks on
+a result with probability attractiveness, and is then satisfied with probability
+satisfaction. They stop once they are satisfied, and otherwise continue to the next
+result with probability gamma. With gamma = 1 this is the simplified DBN.
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from encoded_sessions import RANK_MAX
+
+
+def zipf_probabilities(n, exponent):
+    """
+    Probability of each of n items, where the kth most popular has weight 1/k^exponent
+    """
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def true_parameters(queries, documents, random_state):
+    """
+    Make up an attractiveness and satisfaction for every (query, document)
+    """
+    index = pd.MultiIndex.from_product([queries, documents], names=['query', 'document'])
+    return pd.DataFrame(
+        {
+            'attractiveness': random_state.beta(1, 3, len(index)),
+            'satisfaction': random_state.beta(2, 2, len(index)),
+        },
+        index=index,
+        columns=['attractiveness', 'satisfaction']
+    )
+
+
+def simulate_clicks(attractiveness, satisfaction, gamma, random_state):
+    """
+    Simulate clicks on a (sessions x ranks) matrix of results, given the
+    attractiveness and satisfaction of each result
+    """
+    n_sessions, n_ranks = attractiveness.shape
+    clicks = np.zeros((n_sessions, n_ranks), dtype=bool)
+    examining = np.ones(n_sessions, dtype=bool)
+
+    for rank in range(n_ranks):
+        clicks[:, rank] = examining & (random_state.random_sample(n_sessions) < attractiveness[:, rank])
+        satisfied = clicks[:, rank] & (random_state.random_sample(n_sessions) < satisfaction[:, rank])
+        examining &= ~satisfied & (random_state.random_sample(n_sessions) < gamma)
+
+    return clicks
+
+
+def simulate_searches(n_sessions, n_queries=100, documents_per_query=40, zipf_exponent=1.1, gamma=1.0,
+                      reload_probability=0.1, change_probability=0.03, keep_no_clicks=False, seed=0):
+    """
+    Simulate searches in the same format as get_searches.
+
+    Each query has a fixed set of documents, which are shown in a slightly different
+    order in each session, so every document is seen at a range of ranks.
+
+    Some sessions reload the results page, which repeats the impressions, and sometimes
+    the results change when they do, so all_urls has more than 20 unique URLs
+    (see encode_sessions in encoded_sessions.py).
+
+    Like load_sessions.py, sessions without any clicks are dropped unless keep_no_clicks is set.
+
+    Returns (searches, parameters), where parameters is the true attractiveness and
+    satisfaction of every (query, document).
+    """
+    random_state = np.random.RandomState(seed)
+    queries = np.array([f'query {i}' for i in range(n_queries)], dtype=object)
+    documents = np.array([f'/document-{j}' for j in range(documents_per_query)], dtype=object)
+    parameters = true_parameters(queries, documents, random_state)
+
+    query_ids = random_state.choice(n_queries, n_sessions, p=zipf_probabilities(n_queries, zipf_exponent))
+
+    # Each query has a default ranking, which is perturbed with some noise in each session
+    base_scores = random_state.random_sample((n_queries, documents_per_query))
+    noisy_scores = base_scores[query_ids] + random_state.random_sample((n_sessions, documents_per_query)) * 0.5
+    order = np.argsort(-noisy_scores, axis=1)
+    results = order[:, :RANK_MAX]
+
+    # Parameters are stored in (query, document) order
+    pair_ids = query_ids[:, np.newaxis] * documents_per_query + results
+    clicks = simulate_clicks(
+        parameters.attractiveness.values[pair_ids],
+        parameters.satisfaction.values[pair_ids],
+        gamma,
+        random_state
+    )
+
+    if not keep_no_clicks:
+        clicked = clicks.any(axis=1)
+        query_ids, order, results, clicks = query_ids[clicked], order[clicked], results[clicked], clicks[clicked]
+
+    n_sessions = len(query_ids)
+    reloaded = random_state.random_sample(n_sessions) < reload_probability
+    changed = reloaded & (random_state.random_sample(n_sessions) < change_probability / reload_probability)
+
+    all_urls = []
+    clicked_urls = []
+    for i in range(n_sessions):
+        urls = list(documents[results[i]])
+        if changed[i]:
+            # The second page view showed some documents that weren't there the first time
+            urls = urls + list(documents[order[i, RANK_MAX // 2:RANK_MAX + RANK_MAX // 2]])
+        elif reloaded[i]:
+            urls = urls + urls
+
+        all_urls.append(urls)
+        clicked_urls.append(list(documents[results[i][clicks[i]]]))
+
+    last_click_ranks = RANK_MAX - 1 - np.argmax(clicks[:, ::-1], axis=1)
+    has_clicks = clicks.any(axis=1)
+
+    searches = pd.DataFrame(
+        {
+            'final_click_url': np.where(has_clicks, documents[results[np.arange(n_sessions), last_click_ranks]], None),
+            'final_click_rank': np.where(has_clicks, last_click_ranks + 1, 0),
+            'search_term_lowercase': queries[query_ids],
+            'all_urls': all_urls,
+            'clicked_urls': clicked_urls,
+        },
+        index=pd.Index(np.arange(1, n_sessions + 1), name='id'),
+        columns=['final_click_url', 'final_click_rank', 'search_term_lowercase', 'all_urls', 'clicked_urls']
+    )
+
+    return searches, parameters
+
+
+def to_bigquery_export(searches):
+    """
+    Turn simulated searches into rows of impressions and clicks, like the output of bigquery.py
+    """
+    impression_counts = searches.all_urls.map(len).values
+    click_counts = searches.clicked_urls.map(len).values
+
+    # Impressions of reloaded pages repeat the same ranks
+    impression_ranks = np.concatenate([np.arange(n) % RANK_MAX + 1 for n in impression_counts])
+
+    # Clicks are always on the first page of results
+    click_ranks = np.concatenate([
+        [urls.index(url) + 1 for url in clicked]
+        for urls, clicked in zip(searches.all_urls, searches.clicked_urls)
+    ] + [[]]).astype(np.int64)
+
+    session_ids = np.asarray([f'{i:09d}|1' for i in searches.index], dtype=object)
+    terms = searches.search_term_lowercase.values
+
+    impressions = pd.DataFrame({
+        'sessionId': np.repeat(session_ids, impression_counts),
+        'searchTerm': np.repeat(terms, impression_counts),
+        'hitNumber': 1,
+        'contentIdOrPath': [url for urls in searches.all_urls for url in urls],
+        'linkPosition': impression_ranks,
+        'observationType': 'impression',
+    })
+
+    clicks = pd.DataFrame({
+        'sessionId': np.repeat(session_ids, click_counts),
+        'searchTerm': np.repeat(terms, click_counts),
+        'hitNumber': 2,
+        'contentIdOrPath': [url for urls in searches.clicked_urls for url in urls],
+        'linkPosition': click_ranks,
+        'observationType': 'click',
+    })
+
+    columns = ['sessionId', 'searchTerm', 'hitNumber', 'contentIdOrPath', 'linkPosition', 'observationType']
+    export = pd.concat([impressions, clicks], ignore_index=True)[columns]
+    return export.sort_values('sessionId', kind='mergesort').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a bigquery export from a known click model')
+    parser.add_argument('output_filename')
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--gamma', type=float, default=1.0, help='Probability of continuing after an unsatisfying result')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    searches, parameters = simulate_searches(args.sessions, n_queries=args.queries, gamma=args.gamma, seed=args.seed)
+    to_bigquery_export(searches).to_csv(args.output_filename, index=False)
+    print(f'Simulated {len(searches)} sessions with clicks')
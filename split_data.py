@@ -7,30 +7,60 @@ not be over or underrepresented in the training set.
 TODO: investigate variation in persistentness for each query,
       and consider preserving this in the training/test split
 """
+import argparse
+import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
 from database import get_searches, setup_database
 from ast import literal_eval
-from pandas.util.testing import assert_frame_equal
+from pandas.testing import assert_frame_equal
+from session_store import SessionStore
 
 
-def training_and_test(df):
+def shuffle_within_queries(df, seed=None, stratify=None):
     """
-    Split training and test data for each query
+    Randomly order the sessions for each query, and return each session's
+    position within its query.
+
+    If stratify is a column name, sessions are ordered by that column first
+    (and randomly within it), so that taking every nth session gives a
+    sample with the same distribution of that column.
+    """
+    random_state = np.random.RandomState(seed)
+    query_codes = df.groupby('search_term_lowercase', sort=False).ngroup().values
+
+    sort_keys = [random_state.random_sample(len(df))]
+    if stratify is not None:
+        sort_keys.append(df[stratify].values)
+    sort_keys.append(query_codes)
+
+    order = np.lexsort(sort_keys)
+    query_sizes = np.bincount(query_codes)
+    query_starts = np.r_[0, np.cumsum(query_sizes)[:-1]]
+
+    positions = np.empty(len(df), dtype=np.int64)
+    positions[order] = np.arange(len(df)) - query_starts[query_codes[order]]
+    return positions
+
+
+def assign_folds(df, k, seed=None, stratify=None):
+    """
+    Assign each session to one of k folds, so that every query is spread
+    evenly across the folds.
     """
-    queries = df.search_term_lowercase.unique()
-    train = []
-    test = []
-    for query in queries:
-        query_data = df[df.search_term_lowercase == query]
-        query_train, query_test = train_test_split(query_data, test_size=0.25)
-        train.append(query_train)
-        test.append(query_test)
+    return shuffle_within_queries(df, seed=seed, stratify=stratify) % k
 
-    training_set = pd.concat(train)
-    test_set = pd.concat(test)
 
-    return training_set, test_set
+def training_and_test(df, test_size=0.25, seed=None, stratify=None):
+    """
+    Split training and test data for each query
+
+    Every 1/test_size-th session of each query goes into the test set, so queries with
+    too few sessions to split only appear in the training set.
+    """
+    positions = shuffle_within_queries(df, seed=seed, stratify=stratify)
+    is_test = np.floor((positions + 1) * test_size) > np.floor(positions * test_size)
+
+    return df[~is_test], df[is_test]
 
 
 def load_from_csv(training_file='data/training_set.csv', test_file='data/test_set.csv'):
@@ -44,21 +74,43 @@ def save_to_csv(training, test, training_file='data/training_set.csv', test_file
     test.to_csv(test_file, index=False)
 
 
+def load_stores(training_dir='data/training_set', test_dir='data/test_set'):
+    """
+    Load the training and test sets as memory mapped SessionStores
+    """
+    return SessionStore.load(training_dir), SessionStore.load(test_dir)
+
+
+def load_from_store(training_dir='data/training_set', test_dir='data/test_set'):
+    training, test = load_stores(training_dir, test_dir)
+    return training.to_frame(), test.to_frame()
+
+
+def save_to_store(training, test, training_dir='data/training_set', test_dir='data/test_set'):
+    SessionStore.from_frame(training).save(training_dir)
+    SessionStore.from_frame(test).save(test_dir)
+
+
 if __name__ == '__main__':
     """
     Load sessions from the DB, split into training/test set,
-    and save to CSVs so they can be read in by other scripts.
+    and save them so they can be read in by other scripts.
     """
+    parser = argparse.ArgumentParser(description='Split sessions into training and test sets')
+    parser.add_argument('--seed', type=int, help='Random seed, so the split can be reproduced')
+    parser.add_argument('--stratify', action='store_true', help='Preserve the distribution of final click ranks for each query')
+    args = parser.parse_args()
+
     conn = setup_database()
     searches = get_searches(conn)
 
-    training, test = train_test_split(searches)
+    training, test = training_and_test(searches, seed=args.seed, stratify='final_click_rank' if args.stratify else None)
 
     print(f'split into {len(training)} training rows and {len(test)} test rows')
-    save_to_csv(training, test)
-    training2, test2 = load_from_csv()
+    save_to_store(training, test)
+    training2, test2 = load_from_store()
 
     print('testing output')
-    assert_frame_equal(training.reset_index(drop=True), training2.reset_index(drop=True))
-    assert_frame_equal(test.reset_index(drop=True), test2.reset_index(drop=True))
+    assert_frame_equal(training, training2, check_dtype=False)
+    assert_frame_equal(test, test2, check_dtype=False)
     print('ok')
\ No newline at end of file
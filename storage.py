@@ -0,0 +1,86 @@
+"""
+Save and load named numpy arrays as a directory of .npy files.
+
+Arrays are memory mapped when they are loaded, so loading is almost instant,
+and several processes reading the same files share the same memory.
+Strings (like the query and document dictionaries) are stored as JSON.
+
+Saving again to the same directory is atomic: each save writes its files to a new
+subdirectory, and then replaces metadata.json, which says which subdirectory to read.
+Anything loading at the same time sees either the old files or the new ones, never a mix.
+The previous save is kept, since something may still be reading it.
+"""
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+METADATA_FILE = 'metadata.json'
+DATA_PREFIX = 'data-'
+
+# Number of old saves to keep around for anything that's still reading them
+KEEP_PREVIOUS = 1
+
+
+def save_arrays(directory, arrays, strings=None, metadata=None):
+    """
+    Save a dictionary of arrays, a dictionary of lists of strings, and a
+    dictionary of metadata to a directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    data_directory = tempfile.mkdtemp(prefix=DATA_PREFIX, dir=directory)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(data_directory, f'{name}.npy'), np.ascontiguousarray(array))
+
+    strings = strings or {}
+    for name, values in strings.items():
+        with open(os.path.join(data_directory, f'{name}.json'), 'w') as f:
+            json.dump(list(values), f)
+
+    metadata = dict(metadata or {}, arrays=list(arrays), strings=list(strings), data=os.path.basename(data_directory))
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+        json.dump(metadata, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, os.path.join(directory, METADATA_FILE))
+
+    remove_old_saves(directory, keep=metadata['data'])
+
+
+def remove_old_saves(directory, keep):
+    """
+    Delete all but the KEEP_PREVIOUS most recent saves before the current one
+    """
+    old = [
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(DATA_PREFIX) and name != keep
+    ]
+    old.sort(key=os.path.getmtime, reverse=True)
+    for path in old[KEEP_PREVIOUS:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_arrays(directory, mmap_mode='r'):
+    """
+    Load everything saved by save_arrays.
+    Returns (arrays, strings, metadata)
+    """
+    with open(os.path.join(directory, METADATA_FILE)) as f:
+        metadata = json.load(f)
+
+    # Older saves put everything in the directory itself
+    data_directory = os.path.join(directory, metadata.get('data', ''))
+
+    arrays = {
+        name: np.load(os.path.join(data_directory, f'{name}.npy'), mmap_mode=mmap_mode)
+        for name in metadata['arrays']
+    }
+
+    strings = {}
+    for name in metadata['strings']:
+        with open(os.path.join(data_directory, f'{name}.json')) as f:
+            strings[name] = json.load(f)
+
+    return arrays, strings, metadata
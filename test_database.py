@@ -0,0 +1,87 @@
+"""
+Tests for reading searches back out of the database.
+
+These use a temporary SQLite database, loaded with simulated sessions.
+Run them with: pipenv run pytest
+"""
+from collections import Counter
+import pytest
+import pandas as pd
+import sqlalchemy
+from simulate import simulate_searches, to_bigquery_export
+from clean_data_from_bigquery import clean
+from load_sessions import summarise_sessions
+from database import metadata, SessionLoader, record_dataset, get_searches, get_clicked_urls, get_skipped_urls, query_table
+from database import save_sdbn_counts, get_sdbn_counts
+from encoded_sessions import encode_sessions
+from estimate_relevance import SimplifiedDBNModel, PARAM_COLUMNS
+
+SEARCH_COLUMNS = ['final_click_url', 'final_click_rank', 'search_term_lowercase', 'all_urls', 'clicked_urls']
+URL_COLUMNS = ['result', 'search_term_lowercase']
+
+
+@pytest.fixture
+def conn(tmpdir):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmpdir.join("test.db")}')
+    metadata.create_all(engine)
+    conn = engine.connect()
+
+    searches, _ = simulate_searches(200, n_queries=5, seed=0)
+    invalid_counter = Counter()
+    sessions = summarise_sessions(clean(to_bigquery_export(searches)), invalid_counter=invalid_counter)
+
+    dataset_id = record_dataset(conn, 'test')
+    loader = SessionLoader(conn, dataset_id=dataset_id, high_volume_threshold=0)
+    loader.load(sessions, invalid_counter=invalid_counter)
+    loader.finish()
+
+    yield conn
+    conn.close()
+
+
+def test_get_searches(conn):
+    searches = get_searches(conn)
+
+    assert len(searches) > 0
+    assert list(searches.columns) == SEARCH_COLUMNS
+
+
+def test_get_searches_from_a_dataset_with_no_searches(conn):
+    searches = get_searches(conn, dataset_ids=[99])
+
+    assert searches.empty
+    assert list(searches.columns) == SEARCH_COLUMNS
+
+
+def test_filters_that_match_nothing(conn):
+    query = get_searches(conn).search_term_lowercase.iloc[0]
+    conn.execute(query_table.update().where(query_table.c.search_term_lowercase == query).values(high_volume=False))
+
+    for filters in [{'queries': [query]}, {'queries': ['not a query']}, {'dataset_ids': [99]}]:
+        assert list(get_searches(conn, **filters).columns) == SEARCH_COLUMNS
+        for get_urls in [get_clicked_urls, get_skipped_urls]:
+            urls = get_urls(conn, **filters)
+            assert urls.empty
+            assert list(urls.columns) == URL_COLUMNS
+
+
+def test_filter_by_query(conn):
+    query = get_searches(conn).search_term_lowercase.iloc[0]
+
+    assert set(get_searches(conn, queries=[query]).search_term_lowercase) == {query}
+    assert set(get_clicked_urls(conn, queries=[query]).search_term_lowercase) == {query}
+
+
+def test_sdbn_counts_round_trip(conn):
+    counts = SimplifiedDBNModel.count(encode_sessions(get_searches(conn)))
+    save_sdbn_counts(conn, 1, counts)
+
+    saved = get_sdbn_counts(conn, [1])
+
+    assert list(saved.columns) == ['dataset_id', 'query', 'document'] + PARAM_COLUMNS
+    pd.testing.assert_frame_equal(
+        saved.set_index(['query', 'document'])[PARAM_COLUMNS].sort_index(),
+        counts[PARAM_COLUMNS].sort_index(),
+        check_dtype=False,
+        check_names=False,
+    )
@@ -0,0 +1,39 @@
+"""
+Estimate how uncertain the click model's relevance estimates are, by propagating
+the standard errors of the parameters.
+
+Attractiveness and satisfaction are proportions, so their errors are binomial, and
+relevance is their product. This is quick, but assumes the parameters are independent,
+and doesn't say anything about the evaluation metrics. See bootstrap.py for that.
+"""
+import numpy as np
+
+
+def product_relative_error(a, a_error, b, b_error):
+    """
+    Relative standard error of a * b, given the standard errors of a and b
+    """
+    return np.sqrt((a_error / a) ** 2 + (b_error / b) ** 2)
+
+
+def proportion_error(numerator, denominator):
+    """
+    Binomial standard error of numerator / denominator
+    """
+    p = numerator / denominator
+    return np.sqrt(p * (1 - p) / denominator)
+
+
+def relevance_errors(model):
+    """
+    Standard error of every document's relevance, by propagating the errors of
+    attractiveness and satisfaction
+    """
+    params = model.document_params
+    attractiveness = model.attractiveness
+    satisfaction = model.satisfaction
+    relative_error = product_relative_error(
+        attractiveness, proportion_error(params.attr_numerator, params.attr_denominator),
+        satisfaction, proportion_error(params.sat_numerator, params.sat_denominator)
+    )
+    return attractiveness * satisfaction * relative_error
@@ -0,0 +1,99 @@
+"""
+Update the SDBN model with the sessions from a newly loaded dataset.
+
+SDBN parameters are just ratios of counts, so instead of retraining over the
+whole history, I store the counts for each dataset in the database and add them up.
+Counting one day's sessions only takes a few seconds.
+
+Older datasets can be dropped (--window) or given less weight (--decay).
+With a decay of 0.9, yesterday's counts are worth 0.9 of today's, the day before 0.81, etc.
+
+Every query is counted, and only high volume queries are used when the counts are combined,
+so a query that becomes high volume later still gets its earlier sessions. Datasets counted
+before this only have counts for the queries that were high volume at the time; use
+--recount to count them again.
+
+Usage: python update_model.py DATASET_ID
+"""
+import argparse
+import time
+import pandas as pd
+from database import setup_database, stream_searches, save_sdbn_counts, get_counted_datasets, get_sdbn_counts
+from encoded_sessions import encode_sessions
+from estimate_relevance import SimplifiedDBNModel, PARAM_COLUMNS
+from relevance_index import RelevanceIndex
+
+
+def count_dataset(conn, dataset_id):
+    """
+    Count the sessions for every query from one dataset and save the counts.
+
+    The sessions are streamed from the database, and counted a chunk at a time.
+    """
+    n_searches = 0
+    chunk_counts = []
+    for searches in stream_searches(conn, dataset_ids=[dataset_id], high_volume_only=False):
+        chunk_counts.append(SimplifiedDBNModel.count(encode_sessions(searches)))
+        n_searches += len(searches)
+
+    if not chunk_counts:
+        raise ValueError(f'Dataset {dataset_id} has no searches')
+
+    counts = pd.concat(chunk_counts).groupby(level=['query', 'document']).sum()
+    save_sdbn_counts(conn, dataset_id, counts)
+    return n_searches, len(counts)
+
+
+def combine_counts(counts, dataset_ids, decay=1.0):
+    """
+    Add up the counts from several datasets.
+
+    counts has one row per (dataset, query, document). The newest dataset in
+    dataset_ids has weight 1, and each older one is multiplied by decay again.
+    """
+    ages = {dataset_id: age for age, dataset_id in enumerate(reversed(dataset_ids))}
+    weights = decay ** counts.dataset_id.map(ages)
+
+    weighted = counts[PARAM_COLUMNS].multiply(weights, axis=0)
+    weighted['query'] = counts['query']
+    weighted['document'] = counts['document']
+
+    return weighted.groupby(['query', 'document'])[PARAM_COLUMNS].sum()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the SDBN model with a newly loaded dataset')
+    parser.add_argument('dataset_id', type=int, help='The dataset to add to the model')
+    parser.add_argument('--window', type=int, default=None, help='Only use the most recent N datasets')
+    parser.add_argument('--decay', type=float, default=1.0, help='Weight of each dataset relative to the next one')
+    parser.add_argument('--output', default='data/sdbn_model', help='Where to save the model')
+    parser.add_argument('--index', default=None, help='Also save a relevance index here')
+    parser.add_argument('--recount', action='store_true', help='Count the other datasets in the window again too')
+    args = parser.parse_args()
+
+    conn = setup_database()
+
+    start = time.time()
+    n_searches, n_pairs = count_dataset(conn, args.dataset_id)
+    print(f'Counted {n_searches} searches and {n_pairs} (query, document) pairs in dataset {args.dataset_id} in {time.time() - start:.1f}s')
+
+    dataset_ids = [dataset_id for dataset_id in get_counted_datasets(conn) if dataset_id <= args.dataset_id]
+    if args.window is not None:
+        dataset_ids = dataset_ids[-args.window:]
+
+    if args.recount:
+        for dataset_id in dataset_ids:
+            if dataset_id != args.dataset_id:
+                n_searches, n_pairs = count_dataset(conn, dataset_id)
+                print(f'Recounted {n_searches} searches and {n_pairs} (query, document) pairs in dataset {dataset_id}')
+
+    print(f'Combining counts from datasets {dataset_ids} with decay {args.decay}')
+    counts = combine_counts(get_sdbn_counts(conn, dataset_ids), dataset_ids, decay=args.decay)
+
+    model = SimplifiedDBNModel.from_counts(counts)
+    model.save(args.output)
+    print(f'Saved {len(model.document_params)} (query, document) pairs to {args.output} in {time.time() - start:.1f}s')
+
+    if args.index:
+        RelevanceIndex.build(model).save(args.index)
+        print(f'Saved relevance index to {args.index}')